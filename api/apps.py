@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from map_recommend import db_router  # noqa: F401  システムチェックの登録
+        from . import signals  # noqa: F401
@@ -0,0 +1,85 @@
+"""
+古い散歩記録の軌跡データのアーカイブ
+
+WalkSession の行と集計列（距離・開始終了時刻など）はそのまま残し、
+巨大な trajectory だけを圧縮して WalkSessionTrajectoryArchive へ移す。
+取得時は load_trajectory() で透過的に展開する。
+"""
+import json
+import zlib
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import WalkSession, WalkSessionTrajectoryArchive
+
+
+ARCHIVE_AFTER_DAYS = getattr(settings, "TRAJECTORY_ARCHIVE_AFTER_DAYS", 180)
+
+
+def compress_trajectory(points):
+    return zlib.compress(json.dumps(points, separators=(",", ":")).encode(), 6)
+
+
+def decompress_trajectory(data):
+    return json.loads(zlib.decompress(bytes(data)))
+
+
+def load_trajectory(walk_session):
+    """アーカイブ済みなら展開して、そうでなければそのまま軌跡を返す"""
+    if walk_session.trajectory_archived_at is None:
+        return walk_session.trajectory
+    # prefetch_related('trajectory_archive') 済みなら追加のクエリは発生しない
+    try:
+        archive = walk_session.trajectory_archive
+    except WalkSessionTrajectoryArchive.DoesNotExist:
+        return []
+    return decompress_trajectory(archive.data)
+
+
+def archivable(cutoff):
+    """cutoff より前に終わった（終了時刻が無ければ開始・作成時刻）未アーカイブの散歩"""
+    return WalkSession.objects.annotate(
+        walked_at=Coalesce("end_at", "start_at", "created_at")
+    ).filter(trajectory_archived_at__isnull=True, walked_at__lt=cutoff)
+
+
+def archive_batch(cutoff, batch_size, after_id=0):
+    """
+    id が after_id より大きい対象を最大 batch_size 件アーカイブする
+    戻り値: (アーカイブした件数, 次回の after_id。対象が無ければ None)
+    """
+    with transaction.atomic():
+        # 他のワーカーや利用者の更新中の行は飛ばし、短いトランザクションで進める
+        sessions = list(
+            archivable(cutoff)
+            .filter(id__gt=after_id)
+            .select_for_update(skip_locked=True, of=("self",))
+            .order_by("id")
+            .only("id", "trajectory")[:batch_size]
+        )
+        if not sessions:
+            return 0, None
+
+        # アーカイブ前に読み込まれたインスタンスの save() で元に戻された行は
+        # 古いアーカイブが残っているため上書きする
+        WalkSessionTrajectoryArchive.objects.bulk_create(
+            [
+                WalkSessionTrajectoryArchive(
+                    walk_session=session,
+                    data=compress_trajectory(session.trajectory),
+                    point_count=len(session.trajectory),
+                )
+                for session in sessions
+            ],
+            update_conflicts=True,
+            unique_fields=["walk_session"],
+            update_fields=["data", "point_count", "archived_at"],
+        )
+        # 内容は変わらないため updated_at は進めない（差分同期で再送させない）
+        WalkSession.objects.filter(pk__in=[s.pk for s in sessions]).update(
+            trajectory=[], trajectory_archived_at=timezone.now()
+        )
+    return len(sessions), sessions[-1].pk
@@ -0,0 +1,270 @@
+"""
+AIによる散歩コース生成
+
+- 生成処理は COURSE_GENERATOR_BACKEND で差し替え可能（既定は決定的なローカル実装）
+- リクエストは CourseGenerationJob としてキューに積み、ワーカー
+  （manage.py run_course_generation_worker）が処理する
+- 正規化した ai_context と位置セルが同じ生成済みコースがあれば、生成せずに再利用する
+"""
+import hashlib
+import json
+import math
+import random
+import unicodedata
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Avg, Count, DurationField, ExpressionWrapper, F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import CourseGenerationJob, CourseTemplate
+from .serializers import CourseTemplateSerializer
+
+
+# キャッシュの位置セルの大きさ（度）。0.01度 ≒ 1km
+CELL_SIZE_DEG = getattr(settings, "COURSE_GENERATION_CELL_DEG", 0.01)
+# 実行中のままこの秒数を過ぎたジョブはワーカーが落ちたとみなして再投入する
+LEASE_SECONDS = getattr(settings, "COURSE_GENERATION_LEASE_SEC", 300)
+MAX_ATTEMPTS = getattr(settings, "COURSE_GENERATION_MAX_ATTEMPTS", 3)
+
+
+class BaseCourseGenerator:
+    """生成バックエンドの基底クラス"""
+
+    def generate(self, ai_context, lat, lng):
+        """
+        コース案を返す
+        {"title": ..., "description": ..., "tags": [...],
+         "spots": [{"name": ..., "lat": ..., "lng": ..., "estimated_stay_min": ...}, ...]}
+        """
+        raise NotImplementedError
+
+
+class LocalCourseGenerator(BaseCourseGenerator):
+    """外部APIを使わない決定的な生成（開発・テスト用）"""
+
+    def generate(self, ai_context, lat, lng):
+        seed = cache_key(ai_context, lat, lng)
+        rng = random.Random(seed)
+        mood = ai_context.get("mood") or "おまかせ"
+        tags = [tag for tag in ai_context.get("tags", []) if isinstance(tag, str)]
+        spots = [
+            {
+                "name": f"スポット{i + 1}",
+                "lat": lat + rng.uniform(-0.005, 0.005),
+                "lng": lng + rng.uniform(-0.005, 0.005),
+                "estimated_stay_min": rng.choice([10, 15, 20, 30]),
+            }
+            for i in range(rng.randint(3, 5))
+        ]
+        return {
+            "title": f"{mood}散歩コース",
+            "description": "ローカル生成によるコース案",
+            "tags": tags,
+            "spots": spots,
+        }
+
+
+def get_generator():
+    backend = getattr(
+        settings, "COURSE_GENERATOR_BACKEND", "api.course_generation.LocalCourseGenerator"
+    )
+    return import_string(backend)()
+
+
+def normalize_context(value):
+    """表記揺れ（全角半角・大文字小文字・空白・キー順・タグ順）を吸収する"""
+    if isinstance(value, dict):
+        return {
+            normalize_context(k): normalize_context(v)
+            for k, v in value.items()
+            if v not in (None, "", [], {})
+        }
+    if isinstance(value, list):
+        items = [normalize_context(v) for v in value]
+        if all(isinstance(v, str) for v in items):
+            return sorted(set(items))
+        return items
+    if isinstance(value, str):
+        return " ".join(unicodedata.normalize("NFKC", value).lower().split())
+    return value
+
+
+def location_cell(lat, lng):
+    return f"{math.floor(lat / CELL_SIZE_DEG)}:{math.floor(lng / CELL_SIZE_DEG)}"
+
+
+def cache_key(ai_context, lat, lng):
+    normalized = json.dumps(
+        normalize_context(ai_context), sort_keys=True, ensure_ascii=False, separators=(",", ":")
+    )
+    raw = f"{normalized}|{location_cell(lat, lng)}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def find_cached_template(user, key):
+    return (
+        CourseTemplate.objects.filter(generated_by_ai=True, generation_cache_key=key)
+        .filter(Q(user=user) | Q(is_public=True))
+        .order_by("-created_at")
+        .first()
+    )
+
+
+def _complete(job, **fields):
+    """
+    ジョブの結果を保存する
+    リース切れで別のワーカーに再投入された後なら何もせず False を返す
+    """
+    for attr, value in fields.items():
+        setattr(job, attr, value)
+    return bool(
+        CourseGenerationJob.objects.filter(pk=job.pk, attempts=job.attempts).update(**fields)
+    )
+
+
+def _finish(job, course_template, cache_hit):
+    _complete(
+        job,
+        status=CourseGenerationJob.Status.SUCCEEDED,
+        course_template=course_template,
+        cache_hit=cache_hit,
+        started_at=job.started_at,
+        finished_at=timezone.now(),
+    )
+
+
+def submit_job(user, ai_context, lat, lng):
+    """ジョブを登録する。キャッシュにあれば即座に完了状態で返す"""
+    key = cache_key(ai_context, lat, lng)
+    job = CourseGenerationJob.objects.create(
+        user=user, ai_context=ai_context, lat=lat, lng=lng, cache_key=key
+    )
+    cached = find_cached_template(user, key)
+    if cached is not None:
+        job.started_at = job.created_at
+        _finish(job, cached, cache_hit=True)
+    elif getattr(settings, "COURSE_GENERATION_EAGER", False):
+        run_job(job)
+    return job
+
+
+def requeue_stale_jobs():
+    """リースの切れた実行中ジョブを待機中に戻す。試行回数の上限に達したものは失敗にする"""
+    expired = CourseGenerationJob.objects.filter(
+        status=CourseGenerationJob.Status.RUNNING,
+        started_at__lt=timezone.now() - timedelta(seconds=LEASE_SECONDS),
+    )
+    expired.filter(attempts__gte=MAX_ATTEMPTS).update(
+        status=CourseGenerationJob.Status.FAILED,
+        error="生成がタイムアウトしました。",
+        finished_at=timezone.now(),
+    )
+    return expired.filter(attempts__lt=MAX_ATTEMPTS).update(
+        status=CourseGenerationJob.Status.PENDING,
+        started_at=None,
+    )
+
+
+def claim_next_job():
+    """待機中のジョブを1件取り出して実行中にする（複数ワーカーで重複しない）"""
+    requeue_stale_jobs()
+    with transaction.atomic():
+        job = (
+            CourseGenerationJob.objects.select_for_update(skip_locked=True)
+            .filter(status=CourseGenerationJob.Status.PENDING)
+            .order_by("created_at")
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = CourseGenerationJob.Status.RUNNING
+        job.started_at = timezone.now()
+        job.attempts += 1
+        job.save(update_fields=["status", "started_at", "attempts"])
+    return job
+
+
+def run_job(job):
+    if job.started_at is None:
+        job.started_at = timezone.now()
+    try:
+        # 待機中に同条件のジョブが先に完了していれば、それを使う
+        cached = find_cached_template(job.user, job.cache_key)
+        if cached is not None:
+            _finish(job, cached, cache_hit=True)
+            return job
+
+        result = get_generator().generate(job.ai_context, job.lat, job.lng)
+        serializer = CourseTemplateSerializer(data=result)
+        serializer.is_valid(raise_exception=True)
+        course_template = serializer.save(
+            user=job.user,
+            ai_context=job.ai_context,
+            generated_by_ai=True,
+            generation_cache_key=job.cache_key,
+        )
+        _finish(job, course_template, cache_hit=False)
+    except Exception as e:
+        _complete(
+            job,
+            status=CourseGenerationJob.Status.FAILED,
+            error=str(e),
+            started_at=job.started_at,
+            finished_at=timezone.now(),
+        )
+    return job
+
+
+def process_next_job():
+    job = claim_next_job()
+    if job is None:
+        return None
+    return run_job(job)
+
+
+def _seconds(value):
+    return value.total_seconds() if value is not None else None
+
+
+def metrics(window=timedelta(hours=24)):
+    """直近 window のキャッシュヒット率と生成時間（秒）"""
+    since = timezone.now() - window
+    succeeded = CourseGenerationJob.objects.filter(
+        status=CourseGenerationJob.Status.SUCCEEDED, created_at__gte=since
+    )
+    counts = succeeded.aggregate(
+        total=Count("id"),
+        hits=Count("id", filter=Q(cache_hit=True)),
+    )
+    failed = CourseGenerationJob.objects.filter(
+        status=CourseGenerationJob.Status.FAILED, created_at__gte=since
+    ).count()
+
+    generated = succeeded.filter(cache_hit=False).annotate(
+        latency=ExpressionWrapper(F("finished_at") - F("started_at"), output_field=DurationField()),
+        wait=ExpressionWrapper(F("started_at") - F("created_at"), output_field=DurationField()),
+    )
+    averages = generated.aggregate(latency=Avg("latency"), wait=Avg("wait"))
+    latencies = generated.order_by("latency").values_list("latency", flat=True)
+    misses = counts["total"] - counts["hits"]
+
+    def percentile(p):
+        if not misses:
+            return None
+        return _seconds(latencies[min(misses - 1, int(misses * p))])
+
+    return {
+        "window_sec": int(window.total_seconds()),
+        "requests": counts["total"] + failed,
+        "cache_hits": counts["hits"],
+        "cache_misses": misses,
+        "cache_hit_rate": counts["hits"] / counts["total"] if counts["total"] else None,
+        "failed": failed,
+        "generation_latency_avg_sec": _seconds(averages["latency"]),
+        "generation_latency_p50_sec": percentile(0.5),
+        "generation_latency_p95_sec": percentile(0.95),
+        "queue_wait_avg_sec": _seconds(averages["wait"]),
+    }
@@ -0,0 +1,218 @@
+"""
+フォロー中ユーザーの公開散歩タイムライン
+
+- 通常ユーザーの投稿は書き込み時に各フォロワーの FeedEntry へファンアウトする
+- フォロワー数が FEED_FANOUT_FOLLOWER_LIMIT 以上のユーザーはファンアウトせず、
+  読み取り時にその投稿をマージする（対象は Follow.high_follower で引くため、
+  フォロー数に比例するスキャンはしない）
+- 閾値を下回った時点で、ファンアウトしていなかった投稿をフォロワーへ書き込む
+- 読み取りはどちらも (owner, published_at) のインデックスを使い、
+  1ページあたり page_size 件しか取得しない
+"""
+import heapq
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+
+from .models import CustomUser, FeedEntry, Follow, Like, WalkSession
+
+
+FANOUT_FOLLOWER_LIMIT = getattr(settings, "FEED_FANOUT_FOLLOWER_LIMIT", 1000)
+FANOUT_BATCH_SIZE = getattr(settings, "FEED_FANOUT_BATCH_SIZE", 1000)
+# フォロー開始時にタイムラインへ取り込む過去投稿の件数
+BACKFILL_SIZE = getattr(settings, "FEED_BACKFILL_SIZE", 20)
+
+
+def is_high_follower(user):
+    return user.follower_count >= FANOUT_FOLLOWER_LIMIT
+
+
+def fan_out_walk_session(walk_session):
+    """公開された散歩記録をフォロワーのタイムラインへ書き込む"""
+    author = walk_session.user
+    if not walk_session.is_public:
+        return
+    # 認証時に読み込んだユーザーのフォロワー数は古い可能性があるため読み直す
+    if _follower_count(author) >= FANOUT_FOLLOWER_LIMIT:
+        return
+    _write_entries(walk_session, author)
+
+
+def _write_entries(walk_session, author):
+    follower_ids = (
+        Follow.objects.filter(following=author)
+        .values_list("follower_id", flat=True)
+        .iterator(chunk_size=FANOUT_BATCH_SIZE)
+    )
+    batch = []
+    for follower_id in follower_ids:
+        batch.append(FeedEntry(
+            owner_id=follower_id,
+            walk_session=walk_session,
+            author=author,
+            published_at=walk_session.created_at,
+        ))
+        if len(batch) >= FANOUT_BATCH_SIZE:
+            FeedEntry.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    if batch:
+        FeedEntry.objects.bulk_create(batch, ignore_conflicts=True)
+    WalkSession.objects.filter(pk=walk_session.pk).update(fanned_out=True)
+
+
+def _follower_count(user):
+    count = CustomUser.objects.filter(pk=user.pk).values_list("follower_count", flat=True).get()
+    user.follower_count = count
+    return count
+
+
+def _crossed_up(following, follow):
+    """フォロー直後に呼ぶ。以降の投稿は読み取り時のマージに切り替える"""
+    count = _follower_count(following)
+    if count == FANOUT_FOLLOWER_LIMIT:
+        Follow.objects.filter(following=following).update(high_follower=True)
+    elif count > FANOUT_FOLLOWER_LIMIT:
+        Follow.objects.filter(pk=follow.pk).update(high_follower=True)
+
+
+def _crossed_down(following):
+    """フォロー解除直後に呼ぶ。閾値を下回ったら、マージしていた投稿をファンアウトに戻す"""
+    if _follower_count(following) != FANOUT_FOLLOWER_LIMIT - 1:
+        return
+    Follow.objects.filter(following=following).update(high_follower=False)
+    pending = (
+        WalkSession.objects.filter(user=following, is_public=True, fanned_out=False)
+        .only("id", "created_at")
+        .iterator()
+    )
+    for walk_session in pending:
+        _write_entries(walk_session, following)
+
+
+def _backfill(follower, following):
+    if is_high_follower(following):
+        return
+    recent = (
+        WalkSession.objects.filter(user=following, is_public=True)
+        .order_by("-created_at", "-id")
+        .values_list("id", "created_at")[:BACKFILL_SIZE]
+    )
+    FeedEntry.objects.bulk_create(
+        [
+            FeedEntry(owner=follower, walk_session_id=pk, author=following, published_at=created_at)
+            for pk, created_at in recent
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def follow(follower, following):
+    """フォローする。新規にフォローした場合 True を返す"""
+    with transaction.atomic():
+        relation, created = Follow.objects.get_or_create(follower=follower, following=following)
+        if not created:
+            return False
+        CustomUser.objects.filter(pk=follower.pk).update(following_count=F("following_count") + 1)
+        CustomUser.objects.filter(pk=following.pk).update(follower_count=F("follower_count") + 1)
+        _crossed_up(following, relation)
+        _backfill(follower, following)
+    return True
+
+
+def unfollow(follower, following):
+    """フォロー解除する。解除した場合 True を返す"""
+    with transaction.atomic():
+        deleted, _ = Follow.objects.filter(follower=follower, following=following).delete()
+        if not deleted:
+            return False
+        CustomUser.objects.filter(pk=follower.pk).update(following_count=F("following_count") - 1)
+        CustomUser.objects.filter(pk=following.pk).update(follower_count=F("follower_count") - 1)
+        FeedEntry.objects.filter(owner=follower, author=following).delete()
+        _crossed_down(following)
+    return True
+
+
+# like_count は QuerySet.update() で増減し updated_at を進めないため、
+# 差分同期（/sync/）の応答には含めない（WalkSessionSerializer に追加しないこと）
+def like(user, walk_session):
+    with transaction.atomic():
+        _, created = Like.objects.get_or_create(user=user, walk_session=walk_session)
+        if created:
+            WalkSession.objects.filter(pk=walk_session.pk).update(like_count=F("like_count") + 1)
+    return created
+
+
+def unlike(user, walk_session):
+    with transaction.atomic():
+        deleted, _ = Like.objects.filter(user=user, walk_session=walk_session).delete()
+        if deleted:
+            WalkSession.objects.filter(pk=walk_session.pk).update(like_count=F("like_count") - 1)
+    return bool(deleted)
+
+
+def encode_cursor(published_at, walk_session_id):
+    return f"{published_at.timestamp():.6f}:{walk_session_id}"
+
+
+def decode_cursor(cursor):
+    """カーソル文字列を (published_at, walk_session_id) に変換する。不正な場合は ValueError"""
+    ts, pk = cursor.split(":", 1)
+    try:
+        published_at = datetime.fromtimestamp(float(ts), tz=dt_timezone.utc)
+    except (OverflowError, OSError) as e:
+        raise ValueError("invalid cursor") from e
+    return published_at, int(pk)
+
+
+def get_timeline(user, page_size, cursor=None):
+    """
+    タイムラインの1ページ分を返す
+    戻り値: (WalkSession のリスト, 次ページのカーソル or None)
+    """
+    entry_qs = FeedEntry.objects.filter(owner=user, walk_session__is_public=True)
+    high_follower_ids = list(
+        Follow.objects.filter(follower=user, high_follower=True).values_list("following_id", flat=True)
+    )
+    session_qs = WalkSession.objects.filter(user_id__in=high_follower_ids, is_public=True)
+
+    if cursor is not None:
+        published_at, pk = cursor
+        entry_qs = entry_qs.filter(
+            Q(published_at__lt=published_at) | Q(published_at=published_at, walk_session_id__lt=pk)
+        )
+        session_qs = session_qs.filter(
+            Q(created_at__lt=published_at) | Q(created_at=published_at, id__lt=pk)
+        )
+
+    # ページ境界の判定のため1件多く取得する
+    fanned_out = entry_qs.order_by("-published_at", "-walk_session_id").values_list(
+        "published_at", "walk_session_id"
+    )[:page_size + 1]
+    merged = [fanned_out]
+    if high_follower_ids:
+        merged.append(
+            session_qs.order_by("-created_at", "-id").values_list("created_at", "id")[:page_size + 1]
+        )
+
+    keys = []
+    seen = set()
+    # フォロワー数が閾値をまたいだユーザーの投稿は両方に現れ得るため重複を除く
+    for key in heapq.merge(*merged, reverse=True):
+        if key[1] in seen:
+            continue
+        seen.add(key[1])
+        keys.append(key)
+        if len(keys) > page_size:
+            break
+
+    next_cursor = None
+    if len(keys) > page_size:
+        keys = keys[:page_size]
+        next_cursor = encode_cursor(*keys[-1])
+
+    sessions = WalkSession.objects.select_related("user").defer("trajectory").in_bulk(
+        [pk for _, pk in keys]
+    )
+    return [sessions[pk] for _, pk in keys if pk in sessions], next_cursor
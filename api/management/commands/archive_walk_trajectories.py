@@ -0,0 +1,61 @@
+# api/management/commands/archive_walk_trajectories.py
+
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...archive import ARCHIVE_AFTER_DAYS, archivable, archive_batch
+
+
+class Command(BaseCommand):
+    help = "古い散歩記録の軌跡データを圧縮してアーカイブテーブルへ移す（サービス稼働中に少しずつ実行）"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than-days",
+            type=int,
+            default=ARCHIVE_AFTER_DAYS,
+            help="この日数より前に終わった散歩を対象にする",
+        )
+        parser.add_argument("--batch-size", type=int, default=200)
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0.1,
+            help="バッチ間の待機秒数（本番DBへの負荷を抑える）",
+        )
+        parser.add_argument(
+            "--max-batches",
+            type=int,
+            default=None,
+            help="指定した回数だけ実行して終了する",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="対象件数だけを表示する",
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["older_than_days"])
+
+        if options["dry_run"]:
+            count = archivable(cutoff).count()
+            self.stdout.write(f"アーカイブ対象: {count} 件（{cutoff:%Y-%m-%d} より前）")
+            return
+
+        total = 0
+        batches = 0
+        after_id = 0
+        while options["max_batches"] is None or batches < options["max_batches"]:
+            archived, after_id = archive_batch(cutoff, options["batch_size"], after_id)
+            if after_id is None:
+                break
+            total += archived
+            batches += 1
+            self.stdout.write(f"{total} 件アーカイブしました（id <= {after_id}）")
+            time.sleep(options["sleep"])
+
+        self.stdout.write(self.style.SUCCESS(f"完了: {total} 件"))
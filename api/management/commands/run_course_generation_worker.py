@@ -0,0 +1,38 @@
+# api/management/commands/run_course_generation_worker.py
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...course_generation import process_next_job
+
+
+class Command(BaseCommand):
+    help = "AIコース生成ジョブを順に処理するワーカー"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="待機中のジョブを処理し終えたら終了する",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=1.0,
+            help="ジョブが無いときの待機秒数",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            job = process_next_job()
+            if job is None:
+                if options["once"]:
+                    return
+                time.sleep(options["sleep"])
+                continue
+
+            if job.status == job.Status.SUCCEEDED:
+                self.stdout.write(self.style.SUCCESS(f"job {job.id}: template {job.course_template_id}"))
+            else:
+                self.stdout.write(self.style.ERROR(f"job {job.id}: {job.error}"))
@@ -0,0 +1,121 @@
+"""
+メディアファイルの配信
+
+- 内容ハッシュのファイルは中身が変わらないため、1年の immutable キャッシュを付ける
+- Range リクエスト（動画・大きな画像の部分取得）に対応する
+- 全体の配信は FileResponse（WSGI サーバーの file_wrapper / sendfile）に任せる
+- MEDIA_X_ACCEL_REDIRECT を設定した場合は nginx の X-Accel-Redirect で配信する
+"""
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.views.decorators.http import require_safe
+
+from .storage import content_digest
+
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+CHUNK_SIZE = 64 * 1024
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def parse_range(header, size):
+    """
+    単一範囲の Range ヘッダを (開始, 終了) に変換する（終了を含む）
+    対象外の形式なら None、満たせない範囲なら ValueError
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # bytes=-500 は末尾500バイト
+        length = int(end)
+        if length == 0:
+            raise ValueError("unsatisfiable range")
+        return max(0, size - length), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError("unsatisfiable range")
+    return start, end
+
+
+def _read_range(path, start, length):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+@require_safe
+def serve_media(request, path):
+    try:
+        fullpath = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not os.path.isfile(fullpath):
+        raise Http404
+
+    stat = os.stat(fullpath)
+    size = stat.st_size
+    digest = content_digest(path)
+    etag = f'"{digest}"' if digest else f'"{int(stat.st_mtime)}-{size}"'
+
+    def with_headers(response):
+        response["ETag"] = etag
+        response["Accept-Ranges"] = "bytes"
+        response["Cache-Control"] = IMMUTABLE_CACHE_CONTROL if digest else "no-cache"
+        return response
+
+    if request.headers.get("If-None-Match") == etag:
+        return with_headers(HttpResponseNotModified())
+
+    content_type, encoding = mimetypes.guess_type(fullpath)
+    content_type = content_type or "application/octet-stream"
+
+    accel_prefix = getattr(settings, "MEDIA_X_ACCEL_REDIRECT", "")
+    if accel_prefix:
+        # 本体の送信と Range の処理は nginx に任せる
+        response = HttpResponse(content_type=content_type)
+        # ヘッダは ASCII のみ（日本語ファイル名は Django が MIME エンコードしてしまう）
+        response["X-Accel-Redirect"] = accel_prefix.rstrip("/") + "/" + quote(path.lstrip("/"))
+        return with_headers(response)
+
+    byte_range = None
+    range_header = request.headers.get("Range")
+    if_range = request.headers.get("If-Range")
+    if range_header and (if_range is None or if_range == etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return with_headers(response)
+
+    if byte_range is None:
+        response = FileResponse(open(fullpath, "rb"), content_type=content_type)
+        if encoding:
+            response["Content-Encoding"] = encoding
+        return with_headers(response)
+
+    start, end = byte_range
+    length = end - start + 1
+    response = StreamingHttpResponse(
+        _read_range(fullpath, start, length), status=206, content_type=content_type
+    )
+    response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    response["Content-Length"] = str(length)
+    return with_headers(response)
@@ -0,0 +1,77 @@
+# Generated by Django 5.2.4 on 2026-10-19 07:21
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_follow_like_feedentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource', models.CharField(help_text="'walk-sessions' などのリソース名", max_length=64)),
+                ('object_id', models.BigIntegerField()),
+                ('visible_to_owner', models.BooleanField(default=True)),
+                ('visible_to_others', models.BooleanField(default=False)),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='coursespottemplate',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='coursetemplate',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='userprivacymask',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='walkphoto',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='walksession',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='walkspotvisit',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='coursetemplate',
+            index=models.Index(fields=['updated_at', 'id'], name='coursetemplate_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userprivacymask',
+            index=models.Index(fields=['user', 'updated_at', 'id'], name='privacymask_user_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='walksession',
+            index=models.Index(fields=['user', 'updated_at', 'id'], name='walksession_user_updated_idx'),
+        ),
+        migrations.AddField(
+            model_name='synctombstone',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='synctombstone',
+            index=models.Index(fields=['deleted_at', 'id'], name='synctombstone_deleted_idx'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.4 on 2026-10-19 07:24
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_updated_at_synctombstone'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CourseGenerationJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ai_context', models.JSONField(blank=True, default=dict, help_text='生成時の気分や条件（プロンプト等）')),
+                ('lat', models.FloatField()),
+                ('lng', models.FloatField()),
+                ('cache_key', models.CharField(max_length=64)),
+                ('status', models.CharField(choices=[('pending', '待機中'), ('running', '生成中'), ('succeeded', '完了'), ('failed', '失敗')], default='pending', max_length=16)),
+                ('cache_hit', models.BooleanField(default=False, help_text='既存のコースを再利用した場合 True')),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='coursetemplate',
+            name='generation_cache_key',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='coursetemplate',
+            index=models.Index(fields=['generation_cache_key', '-created_at'], name='coursetemplate_gen_cache_idx'),
+        ),
+        migrations.AddField(
+            model_name='coursegenerationjob',
+            name='course_template',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.coursetemplate'),
+        ),
+        migrations.AddField(
+            model_name='coursegenerationjob',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='course_generation_jobs', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='coursegenerationjob',
+            index=models.Index(fields=['status', 'created_at'], name='genjob_status_created_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-19 07:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_mediablob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WalkSessionTrajectoryArchive',
+            fields=[
+                ('walk_session', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='trajectory_archive', serialize=False, to='api.walksession')),
+                ('data', models.BinaryField()),
+                ('point_count', models.PositiveIntegerField(default=0)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='walksession',
+            name='trajectory_archived_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-19 07:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_walksessiontrajectoryarchive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coursegenerationjob',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
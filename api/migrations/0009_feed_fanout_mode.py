@@ -0,0 +1,38 @@
+# Generated by Django 5.2.4 on 2026-10-19 07:48
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def set_fanout_mode(apps, schema_editor):
+    # 既存データを現在のフォロワー数から埋める
+    Follow = apps.get_model('api', 'Follow')
+    WalkSession = apps.get_model('api', 'WalkSession')
+    limit = getattr(settings, 'FEED_FANOUT_FOLLOWER_LIMIT', 1000)
+    Follow.objects.filter(following__follower_count__gte=limit).update(high_follower=True)
+    WalkSession.objects.filter(is_public=True, user__follower_count__lt=limit).update(fanned_out=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_coursegenerationjob_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='follow',
+            name='high_follower',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='walksession',
+            name='fanned_out',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='follow',
+            index=models.Index(condition=models.Q(('high_follower', True)), fields=['follower'], name='follow_high_follower_idx'),
+        ),
+        migrations.RunPython(set_fanout_mode, migrations.RunPython.noop),
+    ]
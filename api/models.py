@@ -1,10 +1,16 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 
+from .storage import content_hash_storage
+
 
 class CustomUser(AbstractUser):
     email = models.EmailField(unique=True)
 
+    # フォロー数は一覧・フィード判定で頻繁に参照するため非正規化して保持
+    follower_count = models.PositiveIntegerField(default=0, verbose_name="フォロワー数")
+    following_count = models.PositiveIntegerField(default=0, verbose_name="フォロー数")
+
     def __str__(self):
         return self.username
 
@@ -19,8 +25,17 @@ class CourseTemplate(models.Model):
     tags = models.JSONField(default=list, blank=True, help_text="['公園', '静か'] などのタグ")
     
     generated_by_ai = models.BooleanField(default=False)
+    # 正規化した ai_context と位置セルのハッシュ（同条件の生成結果を再利用するため）
+    generation_cache_key = models.CharField(max_length=64, blank=True, default="")
     is_public = models.BooleanField(default=True, verbose_name="公開設定")
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at', 'id'], name='coursetemplate_updated_idx'),
+            models.Index(fields=['generation_cache_key', '-created_at'], name='coursetemplate_gen_cache_idx'),
+        ]
 
     def __str__(self):
         return self.title
@@ -33,6 +48,7 @@ class CourseSpotTemplate(models.Model):
     lng = models.FloatField()
     order_index = models.PositiveIntegerField(default=0, verbose_name="巡回順序")
     estimated_stay_min = models.PositiveIntegerField(default=0, verbose_name="滞在予定時間(分)")
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['order_index']
@@ -48,6 +64,8 @@ class WalkSession(models.Model):
     
     # 【最重要】軌跡データ。[[lat, lng, timestamp], ...] の形式で保存
     trajectory = models.JSONField(default=list, verbose_name="移動経路データ")
+    # 古い軌跡は WalkSessionTrajectoryArchive に圧縮して移し、trajectory は空にする
+    trajectory_archived_at = models.DateTimeField(null=True, blank=True)
     
     total_distance_m = models.FloatField(default=0.0, verbose_name="総移動距離(m)")
     start_at = models.DateTimeField(null=True, blank=True)
@@ -55,9 +73,30 @@ class WalkSession(models.Model):
     
     is_public = models.BooleanField(default=True)
 
+    # フォロワーの FeedEntry へ書き込み済みか（大量フォロワーのユーザーの投稿は False のまま）
+    fanned_out = models.BooleanField(default=False)
+    # いいね数（Like の件数を非正規化したカウンタ）
+    like_count = models.PositiveIntegerField(default=0, verbose_name="いいね数")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'updated_at', 'id'], name='walksession_user_updated_idx'),
+            # 大量フォロワーを持つユーザーの投稿を読み取り時にマージするためのインデックス
+            models.Index(fields=['user', '-created_at', '-id'], name='walksession_user_created_idx'),
+        ]
+
     def __str__(self):
         return f"{self.user.username} - {self.title}"
 
+class WalkSessionTrajectoryArchive(models.Model):
+    """アーカイブした軌跡データ（zlib 圧縮した JSON）"""
+    walk_session = models.OneToOneField(WalkSession, on_delete=models.CASCADE, primary_key=True, related_name='trajectory_archive')
+    data = models.BinaryField()
+    point_count = models.PositiveIntegerField(default=0)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
 class WalkSpotVisit(models.Model):
     """散歩中に実際に立ち寄った場所"""
     walk_session = models.ForeignKey(WalkSession, on_delete=models.CASCADE, related_name='visits')
@@ -67,14 +106,17 @@ class WalkSpotVisit(models.Model):
     lng = models.FloatField()
     arrival_at = models.DateTimeField(null=True, blank=True)
     stay_duration_sec = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
 
 class WalkPhoto(models.Model):
     """散歩中に撮影した写真"""
     walk_session = models.ForeignKey(WalkSession, on_delete=models.CASCADE, related_name='photos')
-    image = models.ImageField(upload_to='walk_photos/')
+    # 同じ内容の画像は1ファイルにまとめて保存する（ファイル名は内容のハッシュ）
+    image = models.ImageField(upload_to='walk_photos/', storage=content_hash_storage)
     lat = models.FloatField(null=True, blank=True)
     lng = models.FloatField(null=True, blank=True)
     taken_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
 
 # 3. SNS・安全機能
@@ -83,4 +125,120 @@ class UserPrivacyMask(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='privacy_masks')
     center_lat = models.FloatField()
     center_lng = models.FloatField()
-    radius_m = models.PositiveIntegerField(default=200, help_text="半径(メートル)")
\ No newline at end of file
+    radius_m = models.PositiveIntegerField(default=200, help_text="半径(メートル)")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'updated_at', 'id'], name='privacymask_user_updated_idx'),
+        ]
+
+
+class Follow(models.Model):
+    """ユーザー間のフォロー関係"""
+    follower = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='following_relations')
+    following = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='follower_relations')
+    # following のフォロワー数が FEED_FANOUT_FOLLOWER_LIMIT 以上か（閾値をまたいだ時に更新する）
+    high_follower = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['follower', 'following'], name='unique_follow'),
+        ]
+        indexes = [
+            # タイムラインで読み取り時にマージする相手だけを引くためのインデックス
+            models.Index(
+                fields=['follower'], condition=models.Q(high_follower=True), name='follow_high_follower_idx'
+            ),
+        ]
+
+
+class Like(models.Model):
+    """公開された散歩記録への「いいね」"""
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='likes')
+    walk_session = models.ForeignKey(WalkSession, on_delete=models.CASCADE, related_name='likes')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'walk_session'], name='unique_like'),
+        ]
+
+
+class FeedEntry(models.Model):
+    """フォロワーごとに事前計算したタイムライン（書き込み時ファンアウト）"""
+    owner = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='feed_entries')
+    walk_session = models.ForeignKey(WalkSession, on_delete=models.CASCADE, related_name='feed_entries')
+    author = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='+')
+    # 並び順は投稿時刻（WalkSession.created_at のコピー）
+    published_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'walk_session'], name='unique_feed_entry'),
+        ]
+        indexes = [
+            models.Index(fields=['owner', '-published_at', '-walk_session'], name='feedentry_owner_published_idx'),
+            models.Index(fields=['owner', 'author'], name='feedentry_owner_author_idx'),
+        ]
+
+
+
+class SyncTombstone(models.Model):
+    """差分同期用の削除記録（削除・非公開化された行をクライアントへ伝える）"""
+    resource = models.CharField(max_length=64, help_text="'walk-sessions' などのリソース名")
+    object_id = models.BigIntegerField()
+    # 削除された行の所有者
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='+')
+    visible_to_owner = models.BooleanField(default=True)
+    visible_to_others = models.BooleanField(default=False)
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['deleted_at', 'id'], name='synctombstone_deleted_idx'),
+        ]
+
+
+
+class CourseGenerationJob(models.Model):
+    """AIによるコース生成のジョブ（キューとして処理し、クライアントは状態をポーリングする）"""
+
+    class Status(models.TextChoices):
+        PENDING = 'pending', '待機中'
+        RUNNING = 'running', '生成中'
+        SUCCEEDED = 'succeeded', '完了'
+        FAILED = 'failed', '失敗'
+
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='course_generation_jobs')
+    ai_context = models.JSONField(default=dict, blank=True, help_text="生成時の気分や条件（プロンプト等）")
+    lat = models.FloatField()
+    lng = models.FloatField()
+    cache_key = models.CharField(max_length=64)
+
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.PENDING)
+    cache_hit = models.BooleanField(default=False, help_text="既存のコースを再利用した場合 True")
+    course_template = models.ForeignKey(CourseTemplate, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    error = models.TextField(blank=True)
+    # ワーカーが取り出した回数（リース切れで再投入されると増える）
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='genjob_status_created_idx'),
+        ]
+
+
+
+class MediaBlob(models.Model):
+    """内容ハッシュで保存したメディアファイルと、それを参照している行の数"""
+    name = models.CharField(max_length=255, unique=True, help_text="ストレージ上のファイル名")
+    sha256 = models.CharField(max_length=64)
+    size = models.PositiveBigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
@@ -1,5 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
+from django.db import transaction
+from django.utils import timezone
 
 from .models import (
     CustomUser,
@@ -8,8 +10,11 @@ from .models import (
     UserPrivacyMask,
     CourseSpotTemplate,
     WalkSpotVisit,
-    WalkPhoto
+    WalkPhoto,
+    CourseGenerationJob,
+    WalkSessionTrajectoryArchive
 )
+from .archive import load_trajectory
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -41,17 +46,130 @@ class RegisterSerializer(serializers.ModelSerializer):
         return user
 
 class CourseSpotTemplateSerializer(serializers.ModelSerializer):
+    # 更新時に既存スポットを特定するため書き込み可能にする
+    id = serializers.IntegerField(required=False)
+
     class Meta:
         model = CourseSpotTemplate
-        fields = ['id', 'name', 'lat', 'lng', 'order_index', 'estimated_stay_min']
+        fields = ['id', 'name', 'lat', 'lng', 'order_index', 'estimated_stay_min', 'updated_at']
+        extra_kwargs = {
+            'order_index': {'required': False},
+        }
+
+
+def _build_spots(course_template, spots_data):
+    # 新規作成ではクライアント指定の id を使わない（主キーの衝突・シーケンスのずれを防ぐ）
+    return [
+        CourseSpotTemplate(
+            course_template=course_template,
+            **{attr: value for attr, value in spot.items() if attr != 'id'},
+        )
+        for spot in spots_data
+    ]
+
+
+class CourseTemplateListSerializer(serializers.ListSerializer):
+    """複数コースをスポットごと一括作成する（AIのバッチ生成用）"""
+
+    @transaction.atomic
+    def create(self, validated_data):
+        spots_list = [attrs.pop('spots', []) for attrs in validated_data]
+        templates = CourseTemplate.objects.bulk_create(
+            [CourseTemplate(**attrs) for attrs in validated_data]
+        )
+        CourseSpotTemplate.objects.bulk_create([
+            spot
+            for template, spots_data in zip(templates, spots_list)
+            for spot in _build_spots(template, spots_data)
+        ])
+        # レスポンス生成時にコースごとのクエリが走らないようまとめて取り直す
+        created = (
+            CourseTemplate.objects.filter(pk__in=[t.pk for t in templates])
+            .select_related('user')
+            .prefetch_related('spots')
+            .in_bulk()
+        )
+        return [created[t.pk] for t in templates]
+
 
 class CourseTemplateSerializer(serializers.ModelSerializer):
-    spots = CourseSpotTemplateSerializer(many=True, read_only=True)
+    spots = CourseSpotTemplateSerializer(many=True, required=False)
     user = UserSerializer(read_only=True)
 
     class Meta:
         model = CourseTemplate
-        fields = ['id', 'user', 'title', 'description', 'ai_context', 'tags', 'generated_by_ai', 'is_public', 'spots']
+        fields = ['id', 'user', 'title', 'description', 'ai_context', 'tags', 'generated_by_ai', 'is_public', 'spots', 'updated_at']
+        list_serializer_class = CourseTemplateListSerializer
+
+    def validate_spots(self, value):
+        # order_index を全く指定しない場合は並び順どおりに採番する
+        if all('order_index' not in spot for spot in value):
+            for index, spot in enumerate(value):
+                spot['order_index'] = index
+            return value
+
+        if any('order_index' not in spot for spot in value):
+            raise serializers.ValidationError("order_index は全スポットで指定するか、全て省略してください。")
+        indexes = [spot['order_index'] for spot in value]
+        if len(set(indexes)) != len(indexes):
+            raise serializers.ValidationError("order_index が重複しています。")
+
+        ids = [spot['id'] for spot in value if 'id' in spot]
+        if len(set(ids)) != len(ids):
+            raise serializers.ValidationError("スポットの id が重複しています。")
+        return value
+
+    @transaction.atomic
+    def create(self, validated_data):
+        spots_data = validated_data.pop('spots', [])
+        course_template = super().create(validated_data)
+        CourseSpotTemplate.objects.bulk_create(_build_spots(course_template, spots_data))
+        return course_template
+
+    @transaction.atomic
+    def update(self, instance, validated_data):
+        spots_data = validated_data.pop('spots', None)
+        if spots_data is None:
+            return super().update(instance, validated_data)
+
+        existing = {spot.id: spot for spot in instance.spots.all()}
+        unknown = [spot['id'] for spot in spots_data if 'id' in spot and spot['id'] not in existing]
+        if unknown:
+            raise serializers.ValidationError({'spots': [f"このコースに存在しないスポットです: {unknown}"]})
+
+        # 親も保存し、スポットだけの変更でも updated_at を進める
+        course_template = super().update(instance, validated_data)
+
+        # リストに含まれない既存スポットは削除する（全件置き換え）
+        keep_ids = {spot['id'] for spot in spots_data if 'id' in spot}
+        CourseSpotTemplate.objects.filter(
+            pk__in=[pk for pk in existing if pk not in keep_ids]
+        ).delete()
+
+        now = timezone.now()
+        to_update = []
+        to_create = []
+        for spot in spots_data:
+            if 'id' in spot:
+                obj = existing[spot.pop('id')]
+                for attr, value in spot.items():
+                    setattr(obj, attr, value)
+                obj.updated_at = now
+                to_update.append(obj)
+            else:
+                to_create.append(CourseSpotTemplate(course_template=course_template, **spot))
+
+        if to_update:
+            CourseSpotTemplate.objects.bulk_update(
+                to_update,
+                ['name', 'lat', 'lng', 'order_index', 'estimated_stay_min', 'updated_at'],
+            )
+        CourseSpotTemplate.objects.bulk_create(to_create)
+
+        # prefetch 済みのキャッシュを捨て、レスポンスに最新のスポットを返す
+        if hasattr(course_template, '_prefetched_objects_cache'):
+            course_template._prefetched_objects_cache.pop('spots', None)
+        return course_template
 
 # 3. 散歩実績（Session）関連
 class WalkSpotVisitSerializer(serializers.ModelSerializer):
@@ -74,8 +192,10 @@ class WalkSessionSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'user', 'course_template', 'title', 
             'trajectory', 'total_distance_m', 
-            'start_at', 'end_at', 'is_public', 'visits', 'photos'
+            'start_at', 'end_at', 'is_public', 'visits', 'photos', 'updated_at',
+            'trajectory_archived_at'
         ]
+        read_only_fields = ['trajectory_archived_at']
 
     # バリデーション例：軌跡データがリスト形式かチェック
     def validate_trajectory(self, value):
@@ -83,8 +203,55 @@ class WalkSessionSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("軌跡データはリスト形式である必要があります。")
         return value
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # 一覧ではアーカイブ済みの軌跡は空のまま返し、詳細取得時だけ展開する
+        if instance.trajectory_archived_at and self.context.get('rehydrate_trajectory'):
+            data['trajectory'] = load_trajectory(instance)
+        return data
+
+    @transaction.atomic
+    def update(self, instance, validated_data):
+        # 軌跡を書き換えた場合はアーカイブを破棄して通常の行に戻す
+        if 'trajectory' in validated_data and instance.trajectory_archived_at:
+            WalkSessionTrajectoryArchive.objects.filter(walk_session=instance).delete()
+            instance.trajectory_archived_at = None
+        return super().update(instance, validated_data)
+
+class FeedWalkSessionSerializer(serializers.ModelSerializer):
+    """タイムライン表示用（軌跡データは含めない）"""
+    user = UserSerializer(read_only=True)
+
+    class Meta:
+        model = WalkSession
+        fields = [
+            'id', 'user', 'course_template', 'title', 'total_distance_m',
+            'start_at', 'end_at', 'like_count', 'created_at'
+        ]
+
 # 4. プライバシー設定
 class UserPrivacyMaskSerializer(serializers.ModelSerializer):
     class Meta:
         model = UserPrivacyMask
-        fields = ['id', 'center_lat', 'center_lng', 'radius_m']
\ No newline at end of file
+        fields = ['id', 'center_lat', 'center_lng', 'radius_m', 'updated_at']
+
+# 5. AIコース生成
+class CourseGenerationJobSerializer(serializers.ModelSerializer):
+    course_template = CourseTemplateSerializer(read_only=True)
+
+    class Meta:
+        model = CourseGenerationJob
+        fields = [
+            'id', 'ai_context', 'lat', 'lng', 'status', 'cache_hit',
+            'course_template', 'error', 'created_at', 'started_at', 'finished_at'
+        ]
+        read_only_fields = ['status', 'cache_hit', 'error', 'started_at', 'finished_at']
+        extra_kwargs = {
+            'lat': {'min_value': -90, 'max_value': 90},
+            'lng': {'min_value': -180, 'max_value': 180},
+        }
+
+    def validate_ai_context(self, value):
+        if not isinstance(value, dict):
+            raise serializers.ValidationError("ai_context はオブジェクト形式である必要があります。")
+        return value
@@ -0,0 +1,11 @@
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .models import WalkPhoto
+
+
+@receiver(post_delete, sender=WalkPhoto)
+def release_walk_photo_image(sender, instance, **kwargs):
+    """写真の削除時（散歩記録ごとの削除を含む）に画像ファイルの参照を外す"""
+    if instance.image:
+        instance.image.delete(save=False)
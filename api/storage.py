@@ -0,0 +1,94 @@
+"""
+内容ハッシュ（sha256）をファイル名にするストレージ
+
+同じ内容のアップロード（再送・リトライを含む）は1ファイルだけ保存し、
+MediaBlob.ref_count で参照数を数えて、参照が無くなった時点でファイルを消す。
+"""
+import hashlib
+import posixpath
+import re
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.core.files.utils import validate_file_name
+from django.db import transaction
+from django.db.models import F
+
+
+HASHED_NAME_RE = re.compile(r"(?:^|/)[0-9a-f]{2}/(?P<digest>[0-9a-f]{64})(?:\.[\w]+)?$")
+
+
+def content_digest(name):
+    """内容ハッシュのファイル名ならハッシュ値を、そうでなければ None を返す"""
+    match = HASHED_NAME_RE.search(name)
+    return match.group("digest") if match else None
+
+
+class ContentHashStorage(FileSystemStorage):
+
+    def hashed_name(self, name, digest):
+        directory = posixpath.dirname(name)
+        ext = posixpath.splitext(name)[1].lower()
+        return posixpath.join(directory, digest[:2], f"{digest}{ext}")
+
+    def save(self, name, content, max_length=None):
+        from .models import MediaBlob
+
+        if name is None:
+            name = content.name
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+
+        sha256 = hashlib.sha256()
+        size = 0
+        for chunk in content.chunks():
+            sha256.update(chunk)
+            size += len(chunk)
+        digest = sha256.hexdigest()
+        name = self.hashed_name(name, digest)
+        validate_file_name(name, allow_relative_path=True)
+
+        with transaction.atomic():
+            # 同じファイルの保存・削除が並行しても実体とカウントがずれないよう行をロックする
+            blob, _ = MediaBlob.objects.select_for_update().get_or_create(
+                name=name, defaults={"sha256": digest, "size": size}
+            )
+            if not self.exists(name):
+                self._save(name, content)
+            MediaBlob.objects.filter(pk=blob.pk).update(ref_count=F("ref_count") + 1)
+        return name
+
+    def delete(self, name):
+        from .models import MediaBlob
+
+        with transaction.atomic():
+            blob = MediaBlob.objects.select_for_update().filter(name=name).first()
+            if blob is None:
+                # 導入前に保存されたファイルは1行からしか参照されていないため、
+                # 呼び出し元のトランザクションが確定した時点で削除する
+                transaction.on_commit(lambda: FileSystemStorage.delete(self, name))
+                return
+            # 行は ref_count=0 のまま残し、保存側と削除側が同じ行をロックし合うようにする
+            # （行を消すと、未コミットの新しい行はここから見えずロックも待てない）
+            if blob.ref_count > 0:
+                MediaBlob.objects.filter(pk=blob.pk).update(ref_count=F("ref_count") - 1)
+            if blob.ref_count <= 1:
+                transaction.on_commit(lambda: self._delete_unreferenced(name))
+
+    def _delete_unreferenced(self, name):
+        from .models import MediaBlob
+
+        with transaction.atomic():
+            blob = MediaBlob.objects.select_for_update().filter(name=name).first()
+            # コミットまでの間に同じ内容が再アップロードされていれば残す
+            if blob is None or blob.ref_count > 0:
+                return
+            super().delete(name)
+            blob.delete()
+
+
+_storage = ContentHashStorage()
+
+
+def content_hash_storage():
+    return _storage
@@ -0,0 +1,151 @@
+"""
+モバイルクライアント向けの差分同期
+
+カーソルはリソースごとの (updated_at, id) と削除記録の (deleted_at, id) を
+まとめて base64 化したもの。クライアントは has_more が false になるまで
+返された cursor で再リクエストし、deleted を適用してから changes を適用する。
+"""
+import base64
+import json
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import CourseTemplate, SyncTombstone, UserPrivacyMask, WalkSession
+from .serializers import (
+    CourseTemplateSerializer,
+    UserPrivacyMaskSerializer,
+    WalkSessionSerializer,
+)
+
+
+BATCH_SIZE = getattr(settings, "SYNC_BATCH_SIZE", 200)
+TOMBSTONE_BATCH_SIZE = getattr(settings, "SYNC_TOMBSTONE_BATCH_SIZE", 1000)
+# 実行中トランザクションの行を読み飛ばさないよう、直近の更新は次回の同期に回す
+# （プライマリから読む前提。レプリカから読むならレプリカ遅延より長くする必要がある）
+SAFETY_LAG = timedelta(seconds=getattr(settings, "SYNC_SAFETY_LAG_SEC", 2))
+
+
+def _walk_sessions(user):
+    return (
+        WalkSession.objects.filter(user=user)
+        .select_related("user")
+        .prefetch_related("visits", "photos", "trajectory_archive")
+    )
+
+
+def _course_templates(user):
+    return (
+        CourseTemplate.objects.filter(Q(user=user) | Q(is_public=True))
+        .select_related("user")
+        .prefetch_related("spots")
+    )
+
+
+def _privacy_masks(user):
+    return UserPrivacyMask.objects.filter(user=user)
+
+
+# リソース名: (クエリセット生成関数, シリアライザ, 他ユーザーにも見えるか)
+RESOURCES = {
+    "walk-sessions": (_walk_sessions, WalkSessionSerializer, False),
+    "course-templates": (_course_templates, CourseTemplateSerializer, True),
+    "user-privacy-masks": (_privacy_masks, UserPrivacyMaskSerializer, False),
+}
+TOMBSTONES_KEY = "tombstones"
+
+
+def record_deletion(instance, resource, visible_to_owner=True, visible_to_others=None):
+    """削除（または他ユーザーからの非公開化）を同期用に記録する"""
+    if visible_to_others is None:
+        visible_to_others = RESOURCES[resource][2] and getattr(instance, "is_public", False)
+    SyncTombstone.objects.create(
+        resource=resource,
+        object_id=instance.pk,
+        user_id=instance.user_id,
+        visible_to_owner=visible_to_owner,
+        visible_to_others=visible_to_others,
+    )
+
+
+def encode_cursor(positions):
+    raw = json.dumps(
+        {key: [ts.isoformat(), pk] for key, (ts, pk) in positions.items()},
+        separators=(",", ":"),
+    )
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """カーソル文字列を {キー: (datetime, id)} に変換する。不正な場合は ValueError"""
+    if not cursor:
+        return {}
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return {
+            key: (datetime.fromisoformat(ts), int(pk))
+            for key, (ts, pk) in raw.items()
+        }
+    except (TypeError, AttributeError, json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise ValueError("invalid cursor") from e
+
+
+def _after(position, ts_field):
+    if position is None:
+        return Q()
+    ts, pk = position
+    return Q(**{f"{ts_field}__gt": ts}) | Q(**{ts_field: ts, "id__gt": pk})
+
+
+def collect_changes(user, positions, context=None):
+    """
+    positions 以降の変更を最大バッチサイズ分集める
+    戻り値: (レスポンス本文, 次回カーソル用の positions)
+    """
+    upper = timezone.now() - SAFETY_LAG
+    positions = dict(positions)
+    # オフライン端末は軌跡を手元に持つ必要があるため、アーカイブ済みでも展開して返す
+    context = {**(context or {}), "rehydrate_trajectory": True}
+    has_more = False
+
+    changes = {}
+    for resource, (get_queryset, serializer_class, _) in RESOURCES.items():
+        rows = list(
+            get_queryset(user)
+            .filter(_after(positions.get(resource), "updated_at"), updated_at__lte=upper)
+            .order_by("updated_at", "id")[:BATCH_SIZE + 1]
+        )
+        if len(rows) > BATCH_SIZE:
+            rows = rows[:BATCH_SIZE]
+            has_more = True
+        if rows:
+            positions[resource] = (rows[-1].updated_at, rows[-1].id)
+        changes[resource] = serializer_class(rows, many=True, context=context).data
+
+    tombstones = list(
+        SyncTombstone.objects.filter(
+            Q(user=user, visible_to_owner=True) | (Q(visible_to_others=True) & ~Q(user=user)),
+            _after(positions.get(TOMBSTONES_KEY), "deleted_at"),
+            deleted_at__lte=upper,
+        )
+        .order_by("deleted_at", "id")
+        .values_list("id", "deleted_at", "resource", "object_id")[:TOMBSTONE_BATCH_SIZE + 1]
+    )
+    if len(tombstones) > TOMBSTONE_BATCH_SIZE:
+        tombstones = tombstones[:TOMBSTONE_BATCH_SIZE]
+        has_more = True
+    if tombstones:
+        positions[TOMBSTONES_KEY] = (tombstones[-1][1], tombstones[-1][0])
+
+    deleted = {resource: [] for resource in RESOURCES}
+    for _, _, resource, object_id in tombstones:
+        deleted.setdefault(resource, []).append(object_id)
+
+    body = {
+        "changes": changes,
+        "deleted": deleted,
+        "has_more": has_more,
+    }
+    return body, positions
@@ -1,3 +1,795 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import Http404
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework.views import APIView
+
+from map_recommend import db_router
+
+from . import archive, course_generation, sync, trajectory
+from .views import SyncView
+from .media import parse_range, serve_media
+from .models import (
+    CourseGenerationJob,
+    CourseSpotTemplate,
+    CustomUser,
+    FeedEntry,
+    Follow,
+    MediaBlob,
+    WalkPhoto,
+    WalkSession,
+    WalkSessionTrajectoryArchive,
+)
+
+
+def create_user(username, **extra):
+    return CustomUser.objects.create_user(
+        username=username, email=f"{username}@example.com", password="password", **extra
+    )
+
+
+def client_for(user):
+    client = APIClient()
+    client.force_authenticate(user)
+    return client
+
+
+class FeedTests(TestCase):
+
+    def setUp(self):
+        self.reader = create_user("reader")
+        self.author = create_user("author")
+        self.client = client_for(self.reader)
+
+    def post_walk(self, user, title, **extra):
+        res = client_for(user).post(
+            "/api/walk-sessions/", {"title": title, "trajectory": [], **extra}, format="json"
+        )
+        self.assertEqual(res.status_code, 201)
+        return res.json()["id"]
+
+    def test_follow_updates_counters_and_rejects_self(self):
+        self.assertEqual(self.client.post(f"/api/users/{self.author.id}/follow/").status_code, 201)
+        self.assertEqual(self.client.post(f"/api/users/{self.author.id}/follow/").status_code, 200)
+        self.assertEqual(self.client.post(f"/api/users/{self.reader.id}/follow/").status_code, 400)
+
+        self.author.refresh_from_db()
+        self.reader.refresh_from_db()
+        self.assertEqual(self.author.follower_count, 1)
+        self.assertEqual(self.reader.following_count, 1)
+
+    def test_public_walks_are_fanned_out_and_paged(self):
+        self.client.post(f"/api/users/{self.author.id}/follow/")
+        for i in range(3):
+            self.post_walk(self.author, f"walk{i}")
+        self.post_walk(self.author, "private", is_public=False)
+        self.assertEqual(FeedEntry.objects.filter(owner=self.reader).count(), 3)
+
+        first = self.client.get("/api/feed/", {"page_size": 2}).json()
+        self.assertEqual([w["title"] for w in first["results"]], ["walk2", "walk1"])
+        second = self.client.get("/api/feed/", {"page_size": 2, "cursor": first["next"]}).json()
+        self.assertEqual([w["title"] for w in second["results"]], ["walk0"])
+        self.assertIsNone(second["next"])
+
+    @mock.patch("api.feed.FANOUT_FOLLOWER_LIMIT", 2)
+    def test_high_follower_walks_are_merged_at_read_time(self):
+        fan = create_user("fan")
+        self.client.post(f"/api/users/{self.author.id}/follow/")
+        self.post_walk(self.author, "before")
+        client_for(fan).post(f"/api/users/{self.author.id}/follow/")
+        self.assertTrue(all(Follow.objects.filter(following=self.author).values_list("high_follower", flat=True)))
+        self.post_walk(self.author, "celebrity")
+
+        self.assertFalse(FeedEntry.objects.filter(walk_session__title="celebrity").exists())
+        results = self.client.get("/api/feed/").json()["results"]
+        self.assertEqual([w["title"] for w in results], ["celebrity", "before"])
+
+    @mock.patch("api.feed.FANOUT_FOLLOWER_LIMIT", 2)
+    def test_posts_are_fanned_out_after_dropping_below_limit(self):
+        fan = create_user("fan")
+        self.client.post(f"/api/users/{self.author.id}/follow/")
+        client_for(fan).post(f"/api/users/{self.author.id}/follow/")
+        self.post_walk(self.author, "while high")
+
+        self.assertEqual(client_for(fan).delete(f"/api/users/{self.author.id}/follow/").status_code, 204)
+        self.assertFalse(Follow.objects.get(follower=self.reader).high_follower)
+        self.assertTrue(FeedEntry.objects.filter(owner=self.reader, walk_session__title="while high").exists())
+        results = self.client.get("/api/feed/").json()["results"]
+        self.assertEqual([w["title"] for w in results], ["while high"])
+
+    def test_timeline_queries_do_not_depend_on_follow_count(self):
+        def timeline_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                self.client.get("/api/feed/")
+            # フォロー先を全件 JOIN してフォロワー数で絞り込まない
+            self.assertFalse(any("follower_count" in q["sql"] for q in ctx.captured_queries))
+            return len(ctx.captured_queries)
+
+        self.client.post(f"/api/users/{self.author.id}/follow/")
+        before = timeline_queries()
+        for i in range(5):
+            self.client.post(f"/api/users/{create_user(f'user{i}').id}/follow/")
+        self.assertEqual(timeline_queries(), before)
+
+    def test_unfollow_removes_entries(self):
+        self.client.post(f"/api/users/{self.author.id}/follow/")
+        self.post_walk(self.author, "walk")
+        self.assertEqual(self.client.delete(f"/api/users/{self.author.id}/follow/").status_code, 204)
+        self.assertEqual(self.client.get("/api/feed/").json()["results"], [])
+
+    def test_like_counter(self):
+        walk_id = self.post_walk(self.author, "walk")
+        self.assertEqual(self.client.post(f"/api/walk-sessions/{walk_id}/like/").status_code, 201)
+        self.assertEqual(self.client.post(f"/api/walk-sessions/{walk_id}/like/").status_code, 200)
+        self.assertEqual(WalkSession.objects.get(pk=walk_id).like_count, 1)
+        self.assertEqual(self.client.delete(f"/api/walk-sessions/{walk_id}/like/").status_code, 204)
+        self.assertEqual(WalkSession.objects.get(pk=walk_id).like_count, 0)
+
+    def test_invalid_cursor_and_page_size(self):
+        for cursor in ["inf:1", "1e20:1", "nan:1", "abc", "1.0:x"]:
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.client.get("/api/feed/", {"cursor": cursor}).status_code, 400)
+        self.assertEqual(self.client.get("/api/feed/", {"page_size": "x"}).status_code, 400)
+
+
+@mock.patch.object(sync, "SAFETY_LAG", timedelta(0))
+class SyncTests(TestCase):
+
+    def setUp(self):
+        self.user = create_user("owner")
+        self.other = create_user("other")
+        self.client = client_for(self.user)
+
+    def pull(self, cursor=None):
+        """has_more が false になるまで取得し、(各ページ, 最後のカーソル) を返す"""
+        pages = []
+        while True:
+            params = {"since": cursor} if cursor else {}
+            res = self.client.get("/api/sync/", params)
+            self.assertEqual(res.status_code, 200)
+            body = res.json()
+            pages.append(body)
+            cursor = body["cursor"]
+            if not body["has_more"]:
+                return pages, cursor
+
+    def ids(self, pages, resource, key="changes"):
+        ids = []
+        for page in pages:
+            if key == "changes":
+                ids += [row["id"] for row in page[key][resource]]
+            else:
+                ids += page[key][resource]
+        return ids
+
+    def test_initial_sync_is_batched(self):
+        for i in range(5):
+            self.client.post("/api/walk-sessions/", {"title": f"walk{i}"}, format="json")
+        with mock.patch.object(sync, "BATCH_SIZE", 2):
+            pages, _ = self.pull()
+        self.assertEqual(len(pages), 3)
+        self.assertTrue(pages[0]["has_more"])
+        self.assertEqual(len(self.ids(pages, "walk-sessions")), 5)
+
+    def test_only_changes_since_cursor_are_returned(self):
+        first = self.client.post("/api/walk-sessions/", {"title": "a"}, format="json").json()["id"]
+        self.client.post("/api/walk-sessions/", {"title": "b"}, format="json")
+        _, cursor = self.pull()
+
+        pages, cursor = self.pull(cursor)
+        self.assertEqual(self.ids(pages, "walk-sessions"), [])
+
+        self.client.patch(f"/api/walk-sessions/{first}/", {"title": "a2"}, format="json")
+        pages, _ = self.pull(cursor)
+        self.assertEqual(self.ids(pages, "walk-sessions"), [first])
+
+    def test_deletions_and_unpublished_templates_are_tombstoned(self):
+        walk = self.client.post("/api/walk-sessions/", {"title": "a"}, format="json").json()["id"]
+        other_client = client_for(self.other)
+        template = other_client.post("/api/course-templates/", {"title": "t"}, format="json").json()["id"]
+        pages, cursor = self.pull()
+        self.assertEqual(self.ids(pages, "course-templates"), [template])
+
+        self.client.delete(f"/api/walk-sessions/{walk}/")
+        other_client.patch(f"/api/course-templates/{template}/", {"is_public": False}, format="json")
+        pages, _ = self.pull(cursor)
+        self.assertEqual(self.ids(pages, "walk-sessions", key="deleted"), [walk])
+        self.assertEqual(self.ids(pages, "course-templates", key="deleted"), [template])
+
+        # 非公開化した本人には削除として届かない
+        other_pages = client_for(self.other).get("/api/sync/").json()
+        self.assertEqual(other_pages["deleted"]["course-templates"], [])
+
+    def test_like_count_is_not_synced(self):
+        walk = self.client.post("/api/walk-sessions/", {"title": "a"}, format="json").json()["id"]
+        pages, _ = self.pull()
+        self.assertNotIn("like_count", pages[0]["changes"]["walk-sessions"][0])
+        self.assertEqual(self.ids(pages, "walk-sessions"), [walk])
+
+    def test_invalid_cursor(self):
+        for cursor in ["!!!", "e30", "W10=", "eyJhIjoxfQ=="]:
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.client.get("/api/sync/", {"since": cursor}).status_code, 400)
+
+
+class CourseTemplateWriteTests(TestCase):
+
+    def setUp(self):
+        self.user = create_user("planner")
+        self.client = client_for(self.user)
+
+    def spot(self, name, **extra):
+        return {"name": name, "lat": 35.0, "lng": 139.0, **extra}
+
+    def test_create_with_spots_assigns_order(self):
+        res = self.client.post(
+            "/api/course-templates/",
+            {"title": "t", "spots": [self.spot("a"), self.spot("b")]},
+            format="json",
+        )
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual([(s["name"], s["order_index"]) for s in res.json()["spots"]], [("a", 0), ("b", 1)])
+
+    def test_order_index_validation(self):
+        for spots in [
+            [self.spot("a", order_index=0), self.spot("b", order_index=0)],
+            [self.spot("a", order_index=0), self.spot("b")],
+        ]:
+            with self.subTest(spots=spots):
+                res = self.client.post("/api/course-templates/", {"title": "t", "spots": spots}, format="json")
+                self.assertEqual(res.status_code, 400)
+                self.assertIn("spots", res.json())
+
+    def test_update_replaces_spot_list(self):
+        created = self.client.post(
+            "/api/course-templates/",
+            {"title": "t", "spots": [self.spot("a"), self.spot("b")]},
+            format="json",
+        ).json()
+        keep = created["spots"][1]["id"]
+        res = self.client.put(
+            f"/api/course-templates/{created['id']}/",
+            {"title": "t2", "spots": [
+                self.spot("new", order_index=0),
+                self.spot("b2", id=keep, order_index=1),
+            ]},
+            format="json",
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(s["name"], s["order_index"]) for s in res.json()["spots"]], [("new", 0), ("b2", 1)])
+        self.assertEqual(res.json()["spots"][1]["id"], keep)
+        self.assertEqual(CourseSpotTemplate.objects.count(), 2)
+
+    def test_update_rejects_foreign_spot_ids(self):
+        created = self.client.post("/api/course-templates/", {"title": "t"}, format="json").json()
+        res = self.client.put(
+            f"/api/course-templates/{created['id']}/",
+            {"title": "t", "spots": [self.spot("x", id=999999)]},
+            format="json",
+        )
+        self.assertEqual(res.status_code, 400)
+
+    def test_bulk_create_uses_few_queries(self):
+        payload = [
+            {"title": f"t{i}", "spots": [self.spot(f"s{j}") for j in range(5)]}
+            for i in range(20)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.post("/api/course-templates/bulk/", payload, format="json")
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(len(res.json()), 20)
+        self.assertEqual(CourseSpotTemplate.objects.count(), 100)
+        self.assertLess(len(queries.captured_queries), 10)
+
+    def test_bulk_create_ignores_client_spot_ids(self):
+        existing = self.client.post(
+            "/api/course-templates/", {"title": "t", "spots": [self.spot("a")]}, format="json"
+        ).json()["spots"][0]["id"]
+        res = self.client.post(
+            "/api/course-templates/bulk/",
+            [{"title": "copy", "spots": [self.spot("a", id=existing)]}],
+            format="json",
+        )
+        self.assertEqual(res.status_code, 201)
+        self.assertNotEqual(res.json()[0]["spots"][0]["id"], existing)
+        self.assertEqual(CourseSpotTemplate.objects.count(), 2)
+
+    def test_bulk_create_limits(self):
+        res = self.client.post("/api/course-templates/bulk/", [{"title": "t"}] * 51, format="json")
+        self.assertEqual(res.status_code, 400)
+        res = self.client.post("/api/course-templates/bulk/", {"title": "t"}, format="json")
+        self.assertEqual(res.status_code, 400)
+
+
+class TrajectorySliceTests(TestCase):
+
+    def setUp(self):
+        self.user = create_user("walker")
+        self.client = client_for(self.user)
+
+    def create_walk(self, points):
+        return WalkSession.objects.create(user=self.user, trajectory=points).id
+
+    def test_time_window_with_iso_timestamps(self):
+        walk = self.create_walk([[35, 139, f"2026-01-01T14:{m:02d}:00+09:00"] for m in range(60)])
+        res = self.client.get(
+            f"/api/walk-sessions/{walk}/",
+            {"from": "2026-01-01T14:05:00+09:00", "to": "2026-01-01T14:07:30+09:00"},
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([p[2][14:16] for p in res.json()["trajectory"]], ["05", "06", "07"])
+        self.assertEqual(res.json()["trajectory_range"], {"offset": 5, "count": 3, "total": 60})
+
+    def test_time_window_with_numeric_timestamps(self):
+        walk = self.create_walk([[1, 1, t] for t in range(1000, 2000, 10)])
+        res = self.client.get(f"/api/walk-sessions/{walk}/", {"from": 1095, "to": 1120})
+        self.assertEqual([p[2] for p in res.json()["trajectory"]], [1100, 1110, 1120])
+
+    def test_time_range_probes_few_points(self):
+        class CountingPoints(list):
+            probes = 0
+
+            def __getitem__(self, index):
+                CountingPoints.probes += 1
+                return super().__getitem__(index)
+
+        points = CountingPoints([[1, 1, t] for t in range(100000)])
+        self.assertEqual(trajectory.time_range(points, 500, 600), (500, 601))
+        self.assertLess(CountingPoints.probes, 40)
+
+    @skipUnless(connection.vendor == "postgresql", "jsonb の部分取得は PostgreSQL のみ")
+    def test_time_window_does_not_load_trajectory(self):
+        walk = self.create_walk([[1, 1, t] for t in range(5000)])
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get(f"/api/walk-sessions/{walk}/", {"from": 1000, "to": 1002})
+        self.assertEqual([p[2] for p in res.json()["trajectory"]], [1000, 1001, 1002])
+        self.assertEqual(res.json()["trajectory_range"], {"offset": 1000, "count": 3, "total": 5000})
+        # 軌跡全体を SELECT しない
+        self.assertFalse(any('"trajectory",' in q["sql"] for q in queries.captured_queries))
+        self.assertLess(len(queries.captured_queries), 40)
+
+    def test_point_range(self):
+        walk = self.create_walk([[1, 1, t] for t in range(10)])
+        res = self.client.get(f"/api/walk-sessions/{walk}/", {"offset": 8, "limit": 5}).json()
+        self.assertEqual([p[2] for p in res["trajectory"]], [8, 9])
+        res = self.client.get(f"/api/walk-sessions/{walk}/", {"offset": 20}).json()
+        self.assertEqual(res["trajectory_range"], {"offset": 10, "count": 0, "total": 10})
+
+    def test_invalid_parameters(self):
+        walk = self.create_walk([[1, 1, 1]])
+        for params in [
+            {"from": "abc"},
+            {"offset": -1},
+            {"limit": 0},
+            {"offset": "x"},
+            {"from": 1, "offset": 0},
+        ]:
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get(f"/api/walk-sessions/{walk}/", params).status_code, 400)
+
+    def test_malformed_stored_points(self):
+        for points, params in [
+            ([[1, 2], [3, 4]], {"from": 0}),
+            ([[1, 2, "abc"], [3, 4, "def"]], {"to": 5}),
+            ([{"lat": 1}], {"from": 0}),
+        ]:
+            with self.subTest(points=points):
+                walk = self.create_walk(points)
+                res = self.client.get(f"/api/walk-sessions/{walk}/", params)
+                self.assertEqual(res.status_code, 422)
+
+
+class BrokenGenerator(course_generation.BaseCourseGenerator):
+
+    def generate(self, ai_context, lat, lng):
+        raise RuntimeError("backend unavailable")
+
+
+class CourseGenerationTests(TestCase):
+
+    def setUp(self):
+        self.user = create_user("dreamer")
+        self.client = client_for(self.user)
+        self.body = {"ai_context": {"mood": "Relax", "tags": ["公園", "カフェ"]}, "lat": 35.6581, "lng": 139.7017}
+
+    def run_worker(self):
+        call_command("run_course_generation_worker", "--once", stdout=StringIO())
+
+    def test_job_is_queued_and_processed(self):
+        res = self.client.post("/api/course-generation-jobs/", self.body, format="json")
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(res.json()["status"], "pending")
+
+        self.run_worker()
+        job = self.client.get(f"/api/course-generation-jobs/{res.json()['id']}/").json()
+        self.assertEqual(job["status"], "succeeded")
+        self.assertFalse(job["cache_hit"])
+        self.assertTrue(job["course_template"]["spots"])
+
+    def test_normalized_context_in_same_cell_hits_cache(self):
+        self.client.post("/api/course-generation-jobs/", self.body, format="json")
+        self.run_worker()
+        similar = {"ai_context": {"tags": ["カフェ ", "公園"], "mood": "ｒｅｌａｘ", "note": ""}, "lat": 35.6589, "lng": 139.7011}
+        res = self.client.post("/api/course-generation-jobs/", similar, format="json")
+        self.assertEqual(res.status_code, 201)
+        self.assertTrue(res.json()["cache_hit"])
+        self.assertIsNotNone(CourseGenerationJob.objects.get(pk=res.json()["id"]).started_at)
+
+    @override_settings(COURSE_GENERATION_EAGER=True)
+    def test_eager_job_records_latency(self):
+        res = self.client.post("/api/course-generation-jobs/", self.body, format="json")
+        self.assertEqual(res.json()["status"], "succeeded")
+        self.assertIsNotNone(CourseGenerationJob.objects.get().started_at)
+
+        metrics = course_generation.metrics()
+        self.assertEqual(metrics["cache_misses"], 1)
+        self.assertIsNotNone(metrics["generation_latency_p50_sec"])
+
+    @override_settings(COURSE_GENERATOR_BACKEND="api.tests.BrokenGenerator")
+    def test_backend_failure_marks_job_failed(self):
+        res = self.client.post("/api/course-generation-jobs/", self.body, format="json")
+        self.run_worker()
+        job = CourseGenerationJob.objects.get(pk=res.json()["id"])
+        self.assertEqual(job.status, CourseGenerationJob.Status.FAILED)
+        self.assertIn("backend unavailable", job.error)
+
+    def test_stale_running_job_is_requeued(self):
+        job = course_generation.submit_job(self.user, {}, 35.0, 139.0)
+        claimed = course_generation.claim_next_job()
+        self.assertEqual(claimed.pk, job.pk)
+        # ワーカーが落ちたままリースが切れた状態
+        CourseGenerationJob.objects.filter(pk=job.pk).update(started_at=claimed.started_at - timedelta(hours=1))
+
+        reclaimed = course_generation.claim_next_job()
+        self.assertEqual(reclaimed.pk, job.pk)
+        self.assertEqual(reclaimed.attempts, 2)
+
+        # 元のワーカーが後から結果を書き込んでも上書きしない
+        self.assertFalse(course_generation._complete(claimed, status=CourseGenerationJob.Status.FAILED))
+        course_generation.run_job(reclaimed)
+        self.assertEqual(CourseGenerationJob.objects.get(pk=job.pk).status, CourseGenerationJob.Status.SUCCEEDED)
+
+    def test_job_fails_after_max_attempts(self):
+        job = course_generation.submit_job(self.user, {}, 35.0, 139.0)
+        CourseGenerationJob.objects.filter(pk=job.pk).update(
+            status=CourseGenerationJob.Status.RUNNING,
+            attempts=course_generation.MAX_ATTEMPTS,
+            started_at=job.created_at - timedelta(hours=1),
+        )
+        self.assertIsNone(course_generation.claim_next_job())
+        self.assertEqual(CourseGenerationJob.objects.get(pk=job.pk).status, CourseGenerationJob.Status.FAILED)
+
+    def test_ai_context_is_optional(self):
+        res = self.client.post("/api/course-generation-jobs/", {"lat": 35.0, "lng": 139.0}, format="json")
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(res.json()["ai_context"], {})
+        self.run_worker()
+        self.assertEqual(CourseGenerationJob.objects.get().status, CourseGenerationJob.Status.SUCCEEDED)
+
+    def test_invalid_request_and_metrics_permission(self):
+        res = self.client.post("/api/course-generation-jobs/", {"ai_context": {}}, format="json")
+        self.assertEqual(res.status_code, 400)
+        for body in (
+            {"ai_context": {}, "lat": 1e308, "lng": 139.0},
+            {"ai_context": {}, "lat": 35.0, "lng": -180.5},
+            {"ai_context": ["a"], "lat": 35.0, "lng": 139.0},
+        ):
+            res = self.client.post("/api/course-generation-jobs/", body, format="json")
+            self.assertEqual(res.status_code, 400, body)
+        self.assertFalse(CourseGenerationJob.objects.exists())
+        self.assertEqual(self.client.get("/api/course-generation-jobs/metrics/").status_code, 403)
+        admin = client_for(create_user("admin", is_staff=True))
+        self.assertEqual(admin.get("/api/course-generation-jobs/metrics/").status_code, 200)
+
+
+class MediaTestCase(TestCase):
+    """MEDIA_ROOT を一時ディレクトリに差し替える"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        overrider = override_settings(MEDIA_ROOT=self.media_root)
+        overrider.enable()
+        self.addCleanup(overrider.disable)
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.media_root, name))
+
+
+class ContentHashStorageTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user("photographer")
+        self.walk = WalkSession.objects.create(user=self.user)
+
+    def upload(self, name, data=b"same image bytes"):
+        return WalkPhoto.objects.create(walk_session=self.walk, image=SimpleUploadedFile(name, data))
+
+    def test_identical_uploads_share_one_file(self):
+        first = self.upload("a.PNG")
+        second = self.upload("b.png")
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertRegex(first.image.name, r"^walk_photos/[0-9a-f]{2}/[0-9a-f]{64}\.png$")
+        self.assertEqual(MediaBlob.objects.get().ref_count, 2)
+        self.assertNotEqual(self.upload("c.png", b"other").image.name, first.image.name)
+
+    def test_file_is_removed_with_last_reference(self):
+        first = self.upload("a.png")
+        self.upload("b.png")
+        name = first.image.name
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(MediaBlob.objects.get().ref_count, 1)
+        self.assertTrue(self.exists(name))
+
+        # 散歩記録ごとの削除（カスケード）でも参照を外す
+        with self.captureOnCommitCallbacks(execute=True):
+            self.walk.delete()
+        self.assertFalse(MediaBlob.objects.exists())
+        self.assertFalse(self.exists(name))
+
+    def test_reupload_before_cleanup_keeps_file(self):
+        photo = self.upload("a.png")
+        name = photo.image.name
+        # 最後の参照を外した直後は行を ref_count=0 で残し、ファイルの削除はコミット後に回す
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            photo.delete()
+        self.assertEqual(MediaBlob.objects.get().ref_count, 0)
+        self.assertTrue(self.exists(name))
+
+        # 削除のコールバックより先に同じ内容がアップロードされた場合
+        self.assertEqual(self.upload("b.png").image.name, name)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(MediaBlob.objects.get().ref_count, 1)
+        self.assertTrue(self.exists(name))
+
+    def test_legacy_file_survives_rollback(self):
+        name = "walk_photos/legacy.png"
+        os.makedirs(os.path.join(self.media_root, "walk_photos"))
+        with open(os.path.join(self.media_root, name), "wb") as f:
+            f.write(b"legacy")
+        photo = WalkPhoto.objects.create(walk_session=self.walk, image=name)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    photo.delete()
+                    raise RuntimeError("rollback")
+            except RuntimeError:
+                pass
+        self.assertTrue(self.exists(name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            WalkPhoto.objects.get(image=name).delete()
+        self.assertFalse(self.exists(name))
+
+
+class MediaServeTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.factory = RequestFactory()
+        self.data = bytes(range(100))
+        self.name = WalkPhoto._meta.get_field("image").storage.save(
+            "walk_photos/x.bin", ContentFile(self.data)
+        )
+
+    def get(self, path=None, **headers):
+        path = path or self.name
+        return serve_media(self.factory.get(f"/media/{path}", headers=headers), path)
+
+    def test_full_response_is_immutable(self):
+        res = self.get()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(b"".join(res.streaming_content), self.data)
+        self.assertIn("immutable", res["Cache-Control"])
+        self.assertEqual(res["Accept-Ranges"], "bytes")
+
+        self.assertEqual(self.get(If_None_Match=res["ETag"]).status_code, 304)
+
+    def test_range_requests(self):
+        res = self.get(Range="bytes=2-5")
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res["Content-Range"], "bytes 2-5/100")
+        self.assertEqual(b"".join(res.streaming_content), self.data[2:6])
+
+        res = self.get(Range="bytes=-3")
+        self.assertEqual(res["Content-Range"], "bytes 97-99/100")
+
+        res = self.get(Range="bytes=500-")
+        self.assertEqual(res.status_code, 416)
+        self.assertEqual(res["Content-Range"], "bytes */100")
+
+        # If-Range が一致しなければ全体を返す
+        self.assertEqual(self.get(Range="bytes=2-5", If_Range='"stale"').status_code, 200)
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range("bytes=0-", 10), (0, 9))
+        self.assertEqual(parse_range("bytes=5-100", 10), (5, 9))
+        self.assertIsNone(parse_range("bytes=0-1,3-4", 10))
+        self.assertIsNone(parse_range("items=0-1", 10))
+        with self.assertRaises(ValueError):
+            parse_range("bytes=-0", 10)
+        with self.assertRaises(ValueError):
+            parse_range("bytes=5-2", 10)
+
+    def test_missing_and_traversal_paths(self):
+        for path in ["walk_photos/nope.png", "../manage.py"]:
+            with self.subTest(path=path), self.assertRaises(Http404):
+                self.get(path)
+
+    @override_settings(MEDIA_X_ACCEL_REDIRECT="/protected-media/")
+    def test_accel_redirect_is_percent_encoded(self):
+        path = "walk_photos/画像 1.png"
+        os.makedirs(os.path.join(self.media_root, "walk_photos"), exist_ok=True)
+        with open(os.path.join(self.media_root, path), "wb") as f:
+            f.write(b"x")
+        res = self.get(path)
+        self.assertEqual(
+            res["X-Accel-Redirect"],
+            "/protected-media/walk_photos/%E7%94%BB%E5%83%8F%201.png",
+        )
+
+
+class TrajectoryArchiveTests(TestCase):
+
+    def setUp(self):
+        self.user = create_user("historian")
+        self.client = client_for(self.user)
+        self.points = [[35, 139, t] for t in range(0, 1000, 10)]
+        walked_at = timezone.now() - timedelta(days=400)
+        self.old = [
+            WalkSession.objects.create(
+                user=self.user, title=f"old{i}", trajectory=self.points, start_at=walked_at, end_at=walked_at
+            )
+            for i in range(3)
+        ]
+        self.recent = WalkSession.objects.create(user=self.user, title="recent", trajectory=self.points)
+
+    def archive(self, *args):
+        out = StringIO()
+        call_command("archive_walk_trajectories", "--sleep", "0", *args, stdout=out)
+        return out.getvalue()
+
+    def test_command_archives_old_trajectories_in_batches(self):
+        self.assertIn("3 件", self.archive("--dry-run"))
+        self.assertFalse(WalkSessionTrajectoryArchive.objects.exists())
+
+        self.archive("--batch-size", "2")
+        self.assertEqual(WalkSessionTrajectoryArchive.objects.count(), 3)
+        self.assertEqual(WalkSession.objects.filter(trajectory=[]).count(), 3)
+        self.recent.refresh_from_db()
+        self.assertIsNone(self.recent.trajectory_archived_at)
+
+    def test_list_is_lazy_and_detail_rehydrates(self):
+        self.archive()
+        rows = {w["title"]: w for w in self.client.get("/api/walk-sessions/").json()}
+        self.assertEqual(rows["old0"]["trajectory"], [])
+        self.assertIsNotNone(rows["old0"]["trajectory_archived_at"])
+
+        walk = self.old[0].id
+        self.assertEqual(self.client.get(f"/api/walk-sessions/{walk}/").json()["trajectory"], self.points)
+        res = self.client.get(f"/api/walk-sessions/{walk}/", {"from": 100, "to": 120}).json()
+        self.assertEqual([p[2] for p in res["trajectory"]], [100, 110, 120])
+
+    def test_writing_trajectory_discards_archive(self):
+        self.archive()
+        walk = self.old[0].id
+        res = self.client.patch(f"/api/walk-sessions/{walk}/", {"title": "renamed"}, format="json").json()
+        self.assertEqual(res["trajectory"], self.points)
+
+        res = self.client.patch(f"/api/walk-sessions/{walk}/", {"trajectory": [[1, 1, 1]]}, format="json").json()
+        self.assertIsNone(res["trajectory_archived_at"])
+        self.assertFalse(WalkSessionTrajectoryArchive.objects.filter(walk_session_id=walk).exists())
+
+    def test_stale_save_can_be_archived_again(self):
+        stale = WalkSession.objects.get(pk=self.old[0].pk)
+        self.archive()
+        # アーカイブ前に読み込んだインスタンスを保存すると軌跡と状態が元に戻る
+        stale.save()
+        self.archive()
+        stale.refresh_from_db()
+        self.assertIsNotNone(stale.trajectory_archived_at)
+        self.assertEqual(archive.load_trajectory(stale), self.points)
+
+    @mock.patch.object(sync, "SAFETY_LAG", timedelta(0))
+    def test_sync_rehydrates_archived_trajectories(self):
+        self.archive()
+        res = self.client.get("/api/sync/").json()
+        rows = {w["title"]: w for w in res["changes"]["walk-sessions"]}
+        self.assertEqual(rows["old0"]["trajectory"], self.points)
+
+
+class RoutedView(db_router.ReplicaRoutingMixin, APIView):
+    """振り分け先を返すだけのビュー"""
+
+    def get(self, request):
+        with_atomic = request.query_params.get("atomic")
+        if with_atomic:
+            with transaction.atomic():
+                alias = db_router.PrimaryReplicaRouter().db_for_read(WalkSession)
+        else:
+            alias = db_router.PrimaryReplicaRouter().db_for_read(WalkSession)
+        return Response({"alias": alias})
+
+    def post(self, request):
+        return Response({"alias": db_router.PrimaryReplicaRouter().db_for_read(WalkSession)})
+
+
+
+# TestCase はテスト全体を atomic() で囲むため、レプリカへ振り分けられない
+@mock.patch.object(db_router, "replica_aliases", return_value=["replica_0"])
+class ReplicaRoutingTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = create_user("reader")
+        self.factory = APIRequestFactory()
+
+    def request(self, method, path="/", user=None, view=RoutedView):
+        request = getattr(self.factory, method)(path)
+        force_authenticate(request, user or self.user)
+        return view.as_view()(request)
+
+    def alias(self, method="get", path="/", user=None):
+        return self.request(method, path, user).data["alias"]
+
+    def test_safe_requests_read_from_replica(self, _):
+        self.assertEqual(self.alias(), "replica_0")
+        # リクエストの外では ContextVar が戻っている
+        self.assertEqual(db_router.PrimaryReplicaRouter().db_for_read(WalkSession), "default")
+
+    def test_context_is_reset_after_unhandled_error(self, _):
+        with mock.patch.object(RoutedView, "get", side_effect=RuntimeError("unhandled")):
+            with self.assertRaises(RuntimeError):
+                self.request("get")
+        self.assertEqual(db_router.PrimaryReplicaRouter().db_for_read(WalkSession), "default")
+
+    def test_writer_sticks_to_primary(self, _):
+        self.assertEqual(self.alias("post"), "default")
+        self.assertEqual(self.alias(), "default")
+        # 他のユーザーは影響を受けない
+        self.assertEqual(self.alias(user=create_user("other")), "replica_0")
+
+        with override_settings(REPLICA_STICKY_SECONDS=0):
+            cache.clear()
+            self.request("post")
+        self.assertEqual(self.alias(), "replica_0")
+
+    def test_atomic_block_reads_from_primary(self, _):
+        self.assertEqual(self.alias(path="/?atomic=1"), "default")
+
+    def test_anonymous_user_reads_from_primary(self, _):
+        request = self.factory.get("/")
+        self.assertEqual(RoutedView.as_view(permission_classes=[])(request).data["alias"], "default")
+
+    def test_sync_is_not_routed(self, _):
+        # レプリカへ振り分けられると存在しない replica_0 への接続で失敗する
+        self.assertEqual(self.request("get", "/api/sync/", view=SyncView).status_code, 200)
+
+    def test_locmem_cache_is_rejected_with_replicas(self, replica_aliases):
+        locmem = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+        shared = {"default": {"BACKEND": "django.core.cache.backends.redis.RedisCache"}}
+        with override_settings(CACHES=locmem):
+            self.assertEqual([e.id for e in db_router.check_sticky_cache(None)], ["map_recommend.E001"])
+            replica_aliases.return_value = []
+            self.assertEqual(db_router.check_sticky_cache(None), [])
+        replica_aliases.return_value = ["replica_0"]
+        with override_settings(CACHES=shared):
+            self.assertEqual(db_router.check_sticky_cache(None), [])
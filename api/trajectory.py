@@ -0,0 +1,113 @@
+"""
+軌跡データ [[lat, lng, timestamp], ...] の部分取得
+
+timestamp は昇順に並んでいる前提で、時刻範囲は二分探索で求める。
+timestamp が ISO8601 文字列の場合は探索で参照した点だけを変換する。
+
+PostgreSQL では軌跡を読み込まず、探索で参照する点（約 log2(n) 個）と
+該当範囲だけを jsonb のまま取り出す（DB側では値ごとに jsonb を展開するが、
+転送と JSON のデコードは参照した点だけになる）。それ以外のDBとアーカイブ済みの軌跡は
+全体を読み込むため、時刻範囲の取得は点の数に比例する。
+"""
+from bisect import bisect_left, bisect_right
+
+from django.db import connection, models
+from django.db.models.expressions import RawSQL
+from django.utils.dateparse import parse_datetime
+
+
+def parse_timestamp(value):
+    """数値（エポック）または ISO8601 文字列を比較可能な数値に変換する。不正な場合は ValueError"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            parsed = parse_datetime(value)
+            if parsed is not None:
+                return parsed.timestamp()
+    raise ValueError(f"invalid timestamp: {value!r}")
+
+
+class MalformedTrajectory(ValueError):
+    """保存済みの軌跡に [lat, lng, timestamp] の形式でない点が含まれている"""
+
+
+def _point_timestamp(point):
+    try:
+        return parse_timestamp(point[2])
+    except (IndexError, KeyError, TypeError, ValueError) as e:
+        raise MalformedTrajectory(f"invalid trajectory point: {point!r}") from e
+
+
+def time_range(points, start=None, end=None):
+    """start <= timestamp <= end となる点の (開始位置, 終了位置) を返す"""
+    lo = 0 if start is None else bisect_left(points, start, key=_point_timestamp)
+    hi = len(points) if end is None else bisect_right(points, end, lo=lo, key=_point_timestamp)
+    return lo, max(lo, hi)
+
+
+COLUMN = '"api_walksession"."trajectory"'
+
+
+def supports_partial_fetch():
+    return connection.vendor == "postgresql"
+
+
+def _slice_expression(offset, last):
+    return RawSQL(
+        f"jsonb_path_query_array({COLUMN}, %s::jsonpath)",
+        (f"$[{offset} to {last}]",),
+        output_field=models.JSONField(),
+    )
+
+
+def _length_expression():
+    return RawSQL(f"jsonb_array_length({COLUMN})", (), output_field=models.IntegerField())
+
+
+def slice_annotations(offset, limit):
+    """
+    PostgreSQL では jsonb のまま切り出し、該当範囲だけを取得・デコードする
+    それ以外のDBでは None を返す（呼び出し側で Python 上で切り出す）
+    """
+    if not supports_partial_fetch():
+        return None
+    last = "last" if limit is None else str(offset + limit - 1)
+    return {
+        "trajectory_slice": _slice_expression(offset, last),
+        "trajectory_total": _length_expression(),
+    }
+
+
+class StoredTrajectory:
+    """
+    DBに保存された軌跡を、参照した点だけを取得するシーケンスとして扱う（PostgreSQL 専用）
+    queryset は対象の散歩記録1件に絞り込んだもの
+    """
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+        self._length = None
+        self._points = {}
+
+    def _value(self, expression):
+        return self.queryset.annotate(value=expression).values_list("value", flat=True).get()
+
+    def __len__(self):
+        if self._length is None:
+            self._length = self._value(_length_expression())
+        return self._length
+
+    def __getitem__(self, index):
+        if index not in self._points:
+            self._points[index] = self._value(
+                RawSQL(f"{COLUMN} -> %s", (index,), output_field=models.JSONField())
+            )
+        return self._points[index]
+
+    def slice(self, start, stop):
+        if stop <= start:
+            return []
+        return self._value(_slice_expression(start, stop - 1))
@@ -5,15 +5,21 @@ from .views import (
     CourseTemplateViewSet,
     WalkSessionViewSet,
     UserPrivacyMaskViewSet, 
+    CourseGenerationJobViewSet,
     RegisterView,
     LoginView,
-    MeView
+    MeView,
+    FollowView,
+    LikeView,
+    FeedView,
+    SyncView
 )
 
 router = DefaultRouter()
 router.register(r'course-templates', CourseTemplateViewSet, basename='course-template')
 router.register(r'walk-sessions', WalkSessionViewSet, basename='walk-session')
 router.register(r'user-privacy-masks', UserPrivacyMaskViewSet, basename='user-privacy-mask')
+router.register(r'course-generation-jobs', CourseGenerationJobViewSet, basename='course-generation-job')
 
 urlpatterns = [
     # 認証（Token発行ベース）
@@ -21,5 +27,13 @@ urlpatterns = [
     path("auth/login/", LoginView.as_view(), name="auth-login"),
     path("auth/me/", MeView.as_view(), name="auth-me"),
 
+    # フォロー・いいね・タイムライン
+    path("users/<int:pk>/follow/", FollowView.as_view(), name="user-follow"),
+    path("walk-sessions/<int:pk>/like/", LikeView.as_view(), name="walk-session-like"),
+    path("feed/", FeedView.as_view(), name="feed"),
+
+    # 差分同期
+    path("sync/", SyncView.as_view(), name="sync"),
+
     path('' , include(router.urls)),
 ]
\ No newline at end of file
@@ -1,23 +1,31 @@
-from rest_framework import generics, permissions, status, viewsets
+from rest_framework import generics, mixins, permissions, status, viewsets
+from rest_framework.decorators import action
 from rest_framework.views import APIView
+from django.shortcuts import get_object_or_404
 from django.db.models import Q
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
 from django.contrib.auth import authenticate
 
+from map_recommend.db_router import ReplicaRoutingMixin
+
 from .serializers import (
     UserSerializer,
     RegisterSerializer,
     CourseTemplateSerializer,
     WalkSessionSerializer,
-    UserPrivacyMaskSerializer
+    UserPrivacyMaskSerializer,
+    FeedWalkSessionSerializer,
+    CourseGenerationJobSerializer
 )
 from .models import (
     CustomUser,
     CourseTemplate,
     WalkSession,
-    UserPrivacyMask
+    UserPrivacyMask,
+    CourseGenerationJob
 )
+from . import archive, course_generation, feed, sync, trajectory
 
 
 class RegisterView(generics.CreateAPIView):
@@ -76,26 +84,51 @@ class MeView(generics.RetrieveAPIView):
         return self.request.user
 
 # 1. コーステンプレート（計画・提案）
-class CourseTemplateViewSet(viewsets.ModelViewSet):
+class CourseTemplateViewSet(ReplicaRoutingMixin, viewsets.ModelViewSet):
     """
     AI提案またはユーザー保存のコーステンプレート
     """
     serializer_class = CourseTemplateSerializer
     permission_classes = [permissions.IsAuthenticated]
+    # bulk で一度に作成できるコース数の上限
+    bulk_max_size = 50
 
     def get_queryset(self):
         # 「自分のもの」または「公開されているもの」を表示
         user = self.request.user
         return CourseTemplate.objects.filter(
             Q(user=user) | Q(is_public=True)
-        ).distinct()
+        ).distinct().select_related('user').prefetch_related('spots')
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        スポットを含む複数コースを1リクエストで作成
+        POST /api/course-templates/bulk/
+        body: [{ "title": "...", "spots": [...] }, ...]
+        """
+        serializer = self.get_serializer(data=request.data, many=True, max_length=self.bulk_max_size)
+        serializer.is_valid(raise_exception=True)
+        self.perform_create(serializer)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def perform_update(self, serializer):
+        was_public = serializer.instance.is_public
+        course_template = serializer.save()
+        # 非公開にしたコースは他ユーザーの端末から消えるよう削除記録を残す
+        if was_public and not course_template.is_public:
+            sync.record_deletion(course_template, "course-templates", visible_to_owner=False, visible_to_others=True)
+
+    def perform_destroy(self, instance):
+        sync.record_deletion(instance, "course-templates")
+        instance.delete()
+
 
 # 2. 散歩ログ（実績）
-class WalkSessionViewSet(viewsets.ModelViewSet):
+class WalkSessionViewSet(ReplicaRoutingMixin, viewsets.ModelViewSet):
     """
     実際の歩行ログの記録
     """
@@ -106,12 +139,104 @@ class WalkSessionViewSet(viewsets.ModelViewSet):
         # 自分のログのみ（セキュリティ担保）
         return WalkSession.objects.filter(user=self.request.user).order_by('-start_at')
 
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        # アーカイブ済みの軌跡は一覧以外（詳細・更新の応答）で展開する
+        context['rehydrate_trajectory'] = self.action != 'list'
+        return context
+
+    def retrieve(self, request, *args, **kwargs):
+        """
+        ?from=&to= （軌跡と同じ形式の時刻）または ?offset=&limit= （点の番号）を
+        指定した場合は軌跡の該当部分だけを返す
+        """
+        params = request.query_params
+        by_time = 'from' in params or 'to' in params
+        by_index = 'offset' in params or 'limit' in params
+        if not by_time and not by_index:
+            return super().retrieve(request, *args, **kwargs)
+        if by_time and by_index:
+            return Response(
+                {"detail": "from/to と offset/limit は同時に指定できません。"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            if by_time:
+                start = trajectory.parse_timestamp(params['from']) if 'from' in params else None
+                end = trajectory.parse_timestamp(params['to']) if 'to' in params else None
+            else:
+                offset = int(params.get('offset', 0))
+                limit = int(params['limit']) if 'limit' in params else None
+                if offset < 0 or (limit is not None and limit < 1):
+                    raise ValueError
+        except ValueError:
+            return Response(
+                {"detail": "軌跡の範囲指定が不正です。"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        queryset = self.get_queryset()
+        annotations = None if by_time else trajectory.slice_annotations(offset, limit)
+        if trajectory.supports_partial_fetch():
+            # 軌跡全体は読み込まず、DB側で切り出した部分だけを取得する
+            queryset = queryset.defer('trajectory')
+        if annotations:
+            queryset = queryset.annotate(**annotations)
+        instance = get_object_or_404(queryset, pk=kwargs['pk'])
+        self.check_object_permissions(request, instance)
+
+        try:
+            if annotations and not instance.trajectory_archived_at:
+                points, total = instance.trajectory_slice, instance.trajectory_total
+            elif by_time and trajectory.supports_partial_fetch() and not instance.trajectory_archived_at:
+                # 二分探索で参照する点だけを1点ずつ取得する
+                stored = trajectory.StoredTrajectory(self.get_queryset().filter(pk=instance.pk))
+                offset, stop = trajectory.time_range(stored, start, end)
+                points, total = stored.slice(offset, stop), len(stored)
+            else:
+                full = archive.load_trajectory(instance)
+                total = len(full)
+                if by_time:
+                    offset, stop = trajectory.time_range(full, start, end)
+                else:
+                    stop = total if limit is None else offset + limit
+                points = full[offset:stop]
+        except trajectory.MalformedTrajectory:
+            return Response(
+                {"detail": "保存されている軌跡データの形式が不正なため、時刻で絞り込めません。"},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            )
+
+        instance.trajectory = points
+        context = self.get_serializer_context()
+        context['rehydrate_trajectory'] = False
+        data = self.get_serializer_class()(instance, context=context).data
+        data['trajectory_range'] = {
+            'offset': min(offset, total),
+            'count': len(points),
+            'total': total,
+        }
+        return Response(data)
+
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+        walk_session = serializer.save(user=self.request.user)
+        feed.fan_out_walk_session(walk_session)
+
+    def perform_update(self, serializer):
+        was_public = serializer.instance.is_public
+        walk_session = serializer.save()
+        # 非公開から公開に切り替えた時点でフォロワーへ配信する
+        if walk_session.is_public and not was_public:
+            feed.fan_out_walk_session(walk_session)
+
+    def perform_destroy(self, instance):
+        sync.record_deletion(instance, "walk-sessions")
+        instance.delete()
 
 
 # 3. プライバシーエリア設定
-class UserPrivacyMaskViewSet(viewsets.ModelViewSet):
+class UserPrivacyMaskViewSet(ReplicaRoutingMixin, viewsets.ModelViewSet):
     """
     自宅周辺などの非公開エリア設定
     """
@@ -122,4 +247,166 @@ class UserPrivacyMaskViewSet(viewsets.ModelViewSet):
         return UserPrivacyMask.objects.filter(user=self.request.user)
 
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
\ No newline at end of file
+        serializer.save(user=self.request.user)
+
+    def perform_destroy(self, instance):
+        sync.record_deletion(instance, "user-privacy-masks")
+        instance.delete()
+
+
+# 4. フォロー・いいね・タイムライン
+class FollowView(ReplicaRoutingMixin, APIView):
+    """
+    フォロー / フォロー解除
+    POST   /api/users/<id>/follow/
+    DELETE /api/users/<id>/follow/
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, pk):
+        target = get_object_or_404(CustomUser, pk=pk)
+        if target.pk == request.user.pk:
+            return Response(
+                {"detail": "自分自身はフォローできません。"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        created = feed.follow(request.user, target)
+        return Response(status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+    def delete(self, request, pk):
+        target = get_object_or_404(CustomUser, pk=pk)
+        feed.unfollow(request.user, target)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class LikeView(ReplicaRoutingMixin, APIView):
+    """
+    いいね / いいね取り消し
+    POST   /api/walk-sessions/<id>/like/
+    DELETE /api/walk-sessions/<id>/like/
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_walk_session(self, request, pk):
+        return get_object_or_404(
+            WalkSession.objects.filter(Q(user=request.user) | Q(is_public=True)),
+            pk=pk,
+        )
+
+    def post(self, request, pk):
+        walk_session = self.get_walk_session(request, pk)
+        created = feed.like(request.user, walk_session)
+        return Response(status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+    def delete(self, request, pk):
+        walk_session = self.get_walk_session(request, pk)
+        feed.unlike(request.user, walk_session)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class FeedView(ReplicaRoutingMixin, APIView):
+    """
+    フォロー中ユーザーの公開散歩タイムライン
+    GET /api/feed/?cursor=<next>&page_size=20
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    default_page_size = 20
+    max_page_size = 100
+
+    def get(self, request):
+        try:
+            page_size = int(request.query_params.get("page_size", self.default_page_size))
+            cursor = request.query_params.get("cursor")
+            cursor = feed.decode_cursor(cursor) if cursor else None
+        except (TypeError, ValueError):
+            return Response(
+                {"detail": "page_size または cursor が不正です。"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        page_size = max(1, min(page_size, self.max_page_size))
+
+        sessions, next_cursor = feed.get_timeline(request.user, page_size, cursor)
+        return Response(
+            {
+                "results": FeedWalkSessionSerializer(sessions, many=True).data,
+                "next": next_cursor,
+            },
+            status=status.HTTP_200_OK,
+        )
+
+
+
+# 5. 差分同期
+class SyncView(APIView):
+    """
+    前回同期以降に作成・更新・削除された行だけを返す
+    GET /api/sync/?since=<cursor>
+    レスポンスの has_more が true の間は返された cursor で続けて取得する
+
+    カーソルの上限はプライマリの時刻で決めるため、レプリカは使わない
+    （レプリカに未反映の行をカーソルが追い越し、取りこぼしになる）
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        try:
+            positions = sync.decode_cursor(request.query_params.get("since"))
+        except ValueError:
+            return Response(
+                {"detail": "since が不正です。"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        body, positions = sync.collect_changes(
+            request.user, positions, context={"request": request}
+        )
+        body["cursor"] = sync.encode_cursor(positions)
+        return Response(body, status=status.HTTP_200_OK)
+
+
+
+# 6. AIコース生成
+class CourseGenerationJobViewSet(
+    ReplicaRoutingMixin,
+    mixins.CreateModelMixin,
+    mixins.RetrieveModelMixin,
+    mixins.ListModelMixin,
+    viewsets.GenericViewSet,
+):
+    """
+    AIによるコース生成ジョブ
+    POST /api/course-generation-jobs/        body: { "ai_context": {...}, "lat": ..., "lng": ... }
+    GET  /api/course-generation-jobs/<id>/   status が succeeded になるまでポーリングする
+    """
+    serializer_class = CourseGenerationJobSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return (
+            CourseGenerationJob.objects.filter(user=self.request.user)
+            .select_related('course_template__user')
+            .prefetch_related('course_template__spots')
+            .order_by('-created_at')
+        )
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        job = course_generation.submit_job(
+            request.user, data.get('ai_context', {}), data['lat'], data['lng']
+        )
+        # キャッシュヒット時は完了済みのジョブを返す
+        if job.status == CourseGenerationJob.Status.PENDING:
+            response_status = status.HTTP_202_ACCEPTED
+        else:
+            response_status = status.HTTP_201_CREATED
+        return Response(self.get_serializer(job).data, status=response_status)
+
+    @action(detail=False, methods=['get'], permission_classes=[permissions.IsAdminUser])
+    def metrics(self, request):
+        """
+        キャッシュヒット率と生成時間
+        GET /api/course-generation-jobs/metrics/
+        """
+        return Response(course_generation.metrics(), status=status.HTTP_200_OK)
@@ -0,0 +1,105 @@
+"""
+プライマリ / リードレプリカの振り分け
+
+- 書き込みと、明示的に許可されていない読み取りは常にプライマリ（default）
+- ReplicaRoutingMixin を付けたビューの安全なメソッド（GET 等）だけをレプリカへ
+- 書き込みを行ったユーザーは REPLICA_STICKY_SECONDS の間プライマリから読む
+  （自分の書き込みが読めることを保証するため。複数プロセス構成では
+  CACHES に共有キャッシュを設定すること）
+"""
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import cache
+from django.db import connections
+from rest_framework.permissions import SAFE_METHODS
+
+
+PRIMARY = "default"
+STICKY_KEY = "db-router:sticky:{}"
+LOCMEM_BACKEND = "django.core.cache.backends.locmem.LocMemCache"
+
+_read_from_replica = ContextVar("read_from_replica", default=False)
+
+
+def replica_aliases():
+    return [alias for alias in settings.DATABASES if alias != PRIMARY]
+
+
+def is_sticky(user):
+    return cache.get(STICKY_KEY.format(user.pk)) is not None
+
+
+def mark_sticky(user):
+    cache.set(STICKY_KEY.format(user.pk), 1, settings.REPLICA_STICKY_SECONDS)
+
+
+@checks.register(checks.Tags.caches, checks.Tags.database)
+def check_sticky_cache(app_configs, **kwargs):
+    """レプリカを使うのにプロセス内キャッシュのままなら、書き込み後の固定が他のワーカーに伝わらない"""
+    if replica_aliases() and settings.CACHES["default"]["BACKEND"] == LOCMEM_BACKEND:
+        return [
+            checks.Error(
+                "リードレプリカを設定する場合、CACHES にはプロセス間で共有されるキャッシュが必要です。",
+                hint="DJANGO_CACHE_BACKEND / DJANGO_CACHE_LOCATION で Redis 等を指定してください。",
+                id="map_recommend.E001",
+            )
+        ]
+    return []
+
+
+class PrimaryReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if not _read_from_replica.get() or connections[PRIMARY].in_atomic_block:
+            return PRIMARY
+        replicas = replica_aliases()
+        return random.choice(replicas) if replicas else PRIMARY
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # レプリカはプライマリの複製なので同一DBとして扱う
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY
+
+
+class ReplicaRoutingMixin:
+    """
+    DRF のビューに付けると、認証済みユーザーの安全なメソッドの読み取りをレプリカへ送る
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        user = request.user
+        if (
+            request.method in SAFE_METHODS
+            and user.is_authenticated
+            and not is_sticky(user)
+        ):
+            self._replica_token = _read_from_replica.set(True)
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            # 例外で finalize_response を通らなかった場合も、同じスレッドの次の処理へ持ち越さない
+            token = getattr(self, "_replica_token", None)
+            if token is not None:
+                _read_from_replica.reset(token)
+                self._replica_token = None
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        user = getattr(request, "user", None)
+        if (
+            request.method not in SAFE_METHODS
+            and user is not None
+            and user.is_authenticated
+        ):
+            mark_sticky(user)
+        return super().finalize_response(request, response, *args, **kwargs)
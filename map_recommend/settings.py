@@ -21,6 +21,11 @@ DB_USER = os.environ.get("POSTGRES_USER", "django")
 DB_PASSWORD = os.environ.get("POSTGRES_PASSWORD", "django")
 DB_HOST = os.environ.get("POSTGRES_HOST", "localhost")
 DB_PORT = os.environ.get("POSTGRES_PORT", "5432")
+# リードレプリカ（"host1:5432,host2" のようにカンマ区切り。未設定ならプライマリのみ）
+DB_REPLICA_HOSTS = os.environ.get("POSTGRES_REPLICA_HOSTS", "")
+# 永続接続の保持秒数（0 でリクエストごとに切断、空文字で無期限）
+DB_CONN_MAX_AGE = os.environ.get("POSTGRES_CONN_MAX_AGE", "60")
+DB_CONN_HEALTH_CHECKS = os.environ.get("POSTGRES_CONN_HEALTH_CHECKS", "true").lower() == "true"
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
@@ -104,17 +109,65 @@ WSGI_APPLICATION = 'map_recommend.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    "default": {
+def _database(host, port, **extra):
+    return {
         "ENGINE": "django.db.backends.postgresql",
         "NAME": DB_NAME,
         "USER": DB_USER,
         "PASSWORD": DB_PASSWORD,
-        "HOST": DB_HOST,
-        "PORT": DB_PORT,
+        "HOST": host,
+        "PORT": port,
+        # 接続を使い回し、再利用前に死活確認する
+        "CONN_MAX_AGE": int(DB_CONN_MAX_AGE) if DB_CONN_MAX_AGE else None,
+        "CONN_HEALTH_CHECKS": DB_CONN_HEALTH_CHECKS,
+        **extra,
+    }
+
+
+DATABASES = {
+    "default": _database(DB_HOST, DB_PORT),
+}
+
+for i, replica in enumerate(h.strip() for h in DB_REPLICA_HOSTS.split(",") if h.strip()):
+    host, _, port = replica.partition(":")
+    DATABASES[f"replica_{i}"] = _database(host, port or DB_PORT, TEST={"MIRROR": "default"})
+
+DATABASE_ROUTERS = ["map_recommend.db_router.PrimaryReplicaRouter"]
+
+# 書き込み後、このユーザーの読み取りをプライマリに固定する秒数（レプリカ遅延より長くする）
+REPLICA_STICKY_SECONDS = int(os.environ.get("POSTGRES_REPLICA_STICKY_SECONDS", "10"))
+
+# 上記の固定状態を全プロセスで共有するため、本番では共有キャッシュを指定すること
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get(
+            "DJANGO_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": os.environ.get("DJANGO_CACHE_LOCATION", ""),
     }
 }
 
+# 差分同期（/sync/）で直近の更新を次回に回す秒数（実行中トランザクションの取りこぼし防止）
+# /sync/ はプライマリから読む。レプリカへ振り分ける場合はレプリカ遅延より大きくすること
+SYNC_SAFETY_LAG_SEC = int(os.environ.get("SYNC_SAFETY_LAG_SEC", "2"))
+
+
+
+# AIコース生成
+# 生成バックエンド（BaseCourseGenerator のサブクラス）
+COURSE_GENERATOR_BACKEND = os.environ.get(
+    "COURSE_GENERATOR_BACKEND", "api.course_generation.LocalCourseGenerator"
+)
+# True ならワーカーを使わずリクエスト内で生成する（開発用）
+COURSE_GENERATION_EAGER = os.environ.get("COURSE_GENERATION_EAGER", "false").lower() == "true"
+# 生成結果を再利用する位置セルの大きさ（度）
+COURSE_GENERATION_CELL_DEG = float(os.environ.get("COURSE_GENERATION_CELL_DEG", "0.01"))
+# 実行中のままこの秒数を過ぎたジョブは再投入する（ワーカー停止への備え）
+COURSE_GENERATION_LEASE_SEC = int(os.environ.get("COURSE_GENERATION_LEASE_SEC", "300"))
+COURSE_GENERATION_MAX_ATTEMPTS = int(os.environ.get("COURSE_GENERATION_MAX_ATTEMPTS", "3"))
+
+# この日数より前の散歩の軌跡をアーカイブする（manage.py archive_walk_trajectories）
+TRAJECTORY_ARCHIVE_AFTER_DAYS = int(os.environ.get("TRAJECTORY_ARCHIVE_AFTER_DAYS", "180"))
 
 
 # Password validation
@@ -154,6 +207,10 @@ USE_TZ = True
 STATIC_URL = 'static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+# DEBUG でなくても Django からメディアを配信する
+SERVE_MEDIA = os.environ.get("SERVE_MEDIA", "false").lower() == "true"
+# nginx の internal location（例: "/protected-media/"）。設定時は X-Accel-Redirect で配信する
+MEDIA_X_ACCEL_REDIRECT = os.environ.get("MEDIA_X_ACCEL_REDIRECT", "")
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field